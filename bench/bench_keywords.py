@@ -0,0 +1,72 @@
+"""关键词匹配微基准：原来的逐个关键词子串判断 vs KeywordMatcher
+
+用法：python bench/bench_keywords.py [--messages 20000]
+"""
+import argparse
+import os
+import random
+import string
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from tests.stubs import load_plugin_module  # noqa: E402
+
+main = load_plugin_module()
+
+
+def linear_match(keywords, message_str):
+    """原 keyword_handler 的做法：每条消息对每个关键词重新 lower() 再做子串判断"""
+    for keyword in keywords:
+        if keyword.lower() in message_str:
+            return keyword
+    return None
+
+
+def make_keywords(count):
+    rng = random.Random(count)
+    chars = string.ascii_letters + "图片色涩导管飞机女优刺刀造人"
+    return ["".join(rng.choice(chars) for _ in range(rng.randint(2, 6))) for _ in range(count)]
+
+
+def make_messages(keywords, count, hit_ratio=0.1):
+    rng = random.Random(0)
+    chars = string.ascii_lowercase + "今天天气不错大家好吃饭了吗"
+    messages = []
+    for _ in range(count):
+        text = "".join(rng.choice(chars) for _ in range(rng.randint(5, 60)))
+        if rng.random() < hit_ratio:
+            text += rng.choice(keywords)
+        messages.append(text.strip().lower())
+    return messages
+
+
+def bench(func, messages):
+    started = time.perf_counter()
+    for message in messages:
+        func(message)
+    return (time.perf_counter() - started) / len(messages) * 1e6
+
+
+def main_():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--messages", type=int, default=20000)
+    args = parser.parse_args()
+
+    print(f"{'关键词数':>8} {'原实现 µs/条':>14} {'KeywordMatcher µs/条':>22} {'加速':>8}")
+    for count in (10, 100, 1000):
+        keywords = make_keywords(count)
+        messages = make_messages(keywords, args.messages)
+        matcher = main.KeywordMatcher(keywords)
+        # 两种实现的结果必须一致（都返回配置顺序中最靠前的命中关键词）
+        for message in messages[:2000]:
+            expected = linear_match(keywords, message)
+            assert matcher.match(message) == expected, message
+        old = bench(lambda m: linear_match(keywords, m), messages)
+        new = bench(matcher.match, messages)
+        print(f"{count:>8} {old:>14.2f} {new:>22.2f} {old / new:>7.1f}x")
+
+
+if __name__ == "__main__":
+    main_()
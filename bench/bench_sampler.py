@@ -0,0 +1,72 @@
+"""去重随机抽取基准：原来的每次重建可用列表 + 打乱 vs NonRepeatingSampler
+
+用法：python bench/bench_sampler.py
+"""
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from tests.stubs import load_plugin_module  # noqa: E402
+
+main = load_plugin_module()
+
+WINDOW = 3600
+
+
+def legacy_pick(lines, sent_images, now):
+    """原 _get_random_image_from_file 的做法：清理过期记录、重建可用列表、整体打乱后再随机选择"""
+    for url in [url for url, sent_at in sent_images.items() if now - sent_at > WINDOW]:
+        del sent_images[url]
+    available_urls = [url for url in lines if url not in sent_images]
+    if not available_urls:
+        available_urls = list(lines)
+    random.shuffle(available_urls)
+    image_url = random.choice(available_urls)
+    sent_images[image_url] = now
+    return image_url
+
+
+def bench_legacy(lines, picks):
+    sent_images = {}
+    started = time.perf_counter()
+    for i in range(picks):
+        legacy_pick(lines, sent_images, float(i))
+    return (time.perf_counter() - started) / picks * 1e6
+
+
+def bench_sampler(lines, picks):
+    started = time.perf_counter()
+    sampler = main.NonRepeatingSampler(lines, WINDOW)
+    build = time.perf_counter() - started
+    started = time.perf_counter()
+    seen = set()
+    for i in range(picks):
+        # 所有抽取都在去重窗口内，不应出现重复
+        url, repeated = sampler.pick(i * 0.001)
+        assert not repeated and url not in seen
+        seen.add(url)
+    return build * 1000, (time.perf_counter() - started) / picks * 1e6
+
+
+def main_():
+    print(f"{'URL数':>9} {'原实现 µs/次':>14} {'采样器 µs/次':>14} {'采样器建立 ms':>14}")
+    for size in (1_000, 100_000, 1_000_000):
+        lines = tuple(f"https://example.com/img/{i}.jpg" for i in range(size))
+        legacy_picks = max(3, min(500, 5_000_000 // size))
+        old = bench_legacy(lines, legacy_picks)
+        build_ms, new = bench_sampler(lines, min(size, 100_000))
+        print(f"{size:>9} {old:>14.1f} {new:>14.2f} {build_ms:>14.1f}")
+
+    # 池耗尽后允许重复，到期后重新可用
+    sampler = main.NonRepeatingSampler(("a", "b"), WINDOW)
+    assert {sampler.pick(0)[0], sampler.pick(0)[0]} == {"a", "b"}
+    assert sampler.pick(1)[1] is True
+    sampler.release_expired(WINDOW + 2)
+    assert sampler.available_count == 2
+
+
+if __name__ == "__main__":
+    main_()
@@ -0,0 +1,134 @@
+"""图片压缩基准：各组压缩参数节省的字节数、单张处理耗时，以及端到端发送时间
+
+发送时间 = 插件从收到消息到产生图片回复的耗时 + 按上行带宽估算的图片上传耗时。
+端到端部分在替身 AstrBot 环境中创建插件实例，从本地图片服务器取原图，分别在不压缩和压缩时回放消息。
+
+用法：python bench/bench_transform.py [--count 8] [--uplink-mbps 20]
+"""
+import argparse
+import asyncio
+import io
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from PIL import Image as PILImage, ImageFilter  # noqa: E402
+
+from tests.image_server import ImageServer  # noqa: E402
+from tests.stubs import AstrMessageEvent, collect, load_plugin_module, make_plugin  # noqa: E402
+
+main = load_plugin_module()
+
+# (名称, 尺寸, 格式)：模拟 lolicon 原图（大尺寸PNG）和常见的JPEG图片
+SOURCES = (
+    ("PNG 2400x3400", (2400, 3400), "PNG"),
+    ("JPEG 1920x1080", (1920, 1080), "JPEG"),
+)
+# (名称, image_max_dimension, image_format, image_quality, image_max_kb)
+CONFIGS = (
+    ("2048 JPEG q85", 2048, "JPEG", 85, 0),
+    ("1280 WEBP q80", 1280, "WEBP", 80, 0),
+    ("JPEG ≤500KB", 0, "JPEG", 85, 500),
+)
+
+
+def make_photo(size, fmt, seed=0):
+    """生成接近照片压缩特性的测试图片：渐变叠加模糊噪声（纯色或纯噪声图都不具代表性）"""
+    red = PILImage.linear_gradient("L").rotate(seed * 13).resize(size)
+    green = PILImage.radial_gradient("L").resize(size)
+    blue = PILImage.effect_noise(size, 40 + seed).filter(ImageFilter.GaussianBlur(0.8))
+    buffer = io.BytesIO()
+    PILImage.merge("RGB", (red, green, blue)).save(buffer, fmt)
+    return buffer.getvalue()
+
+
+def upload_ms(size_bytes, uplink_mbps):
+    return size_bytes * 8 / (uplink_mbps * 1e6) * 1000
+
+
+def bench_configs(work_dir, uplink_mbps):
+    print(f"{'原图':<16} {'压缩参数':<14} {'原图KB':>8} {'输出KB':>8} {'节省':>6} {'压缩ms':>8} {'上传ms 前/后':>14}")
+    for name, size, fmt in SOURCES:
+        src = os.path.join(work_dir, "src.jpg" if fmt == "JPEG" else f"src.{fmt.lower()}")
+        with open(src, "wb") as f:
+            f.write(make_photo(size, fmt))
+        source_size = os.path.getsize(src)
+        for config_name, max_dimension, target_format, quality, max_kb in CONFIGS:
+            dst = os.path.join(work_dir, f"out_{config_name}")
+            started = time.perf_counter()
+            ext = main._transform_image(src, dst, max_dimension, target_format, quality, max_kb * 1024)
+            elapsed = (time.perf_counter() - started) * 1000
+            output_size = os.path.getsize(dst) if ext else source_size
+            print(
+                f"{name:<16} {config_name:<14} {source_size / 1024:>8.0f} {output_size / 1024:>8.0f} "
+                f"{1 - output_size / source_size:>6.0%} {elapsed:>8.0f} "
+                f"{upload_ms(source_size, uplink_mbps):>6.0f}/{upload_ms(output_size, uplink_mbps):<6.0f}"
+            )
+
+
+async def send_times(server, work_dir, count, uplink_mbps, **config):
+    """依次发送 count 条触发消息，返回 [(回复耗时ms, 图片字节数)]"""
+    tu_dir = os.path.join(work_dir, "tu")
+    os.makedirs(tu_dir, exist_ok=True)
+    with open(os.path.join(tu_dir, "bench.txt"), "w", encoding="utf-8") as f:
+        f.writelines(f"{server.url}/img/{i}.png\n" for i in range(count))
+    plugin = make_plugin(os.path.join(work_dir, "run"), tu_dir=tu_dir, keywords=["bench"], external_api="",
+                         user_rate_per_minute=0, group_rate_per_minute=0, **config)
+    samples = []
+    try:
+        for i in range(count):
+            started = time.perf_counter()
+            results = await collect(plugin.keyword_handler(AstrMessageEvent("来张bench", sender_id=str(i))))
+            elapsed = (time.perf_counter() - started) * 1000
+            images = [result.image for result in results if result.image]
+            if images:
+                samples.append((elapsed, os.path.getsize(images[0])))
+    finally:
+        await plugin.terminate()
+    return samples
+
+
+async def bench_end_to_end(work_dir, count, uplink_mbps):
+    name, size, fmt = SOURCES[0]
+    images = [make_photo(size, fmt, seed) for seed in range(count)]
+    print(f"\n端到端（{name} 原图, {count} 张, 上行 {uplink_mbps}Mbps）")
+    print(f"{'压缩参数':<14} {'回复ms':>8} {'图片KB':>8} {'上传ms':>8} {'发送ms':>8}")
+    with ImageServer(images=images) as server:
+        runs = [("不压缩", {})] + [
+            (config_name, {"image_max_dimension": max_dimension, "image_format": target_format,
+                           "image_quality": quality, "image_max_kb": max_kb})
+            for config_name, max_dimension, target_format, quality, max_kb in CONFIGS
+        ]
+        for i, (config_name, config) in enumerate(runs):
+            samples = await send_times(server, os.path.join(work_dir, f"e2e{i}"), count, uplink_mbps, **config)
+            if not samples:
+                print(f"{config_name:<14} 没有收到图片回复")
+                continue
+            reply = sum(elapsed for elapsed, _ in samples) / len(samples)
+            size_bytes = sum(size_bytes for _, size_bytes in samples) / len(samples)
+            upload = upload_ms(size_bytes, uplink_mbps)
+            print(f"{config_name:<14} {reply:>8.0f} {size_bytes / 1024:>8.0f} {upload:>8.0f} {reply + upload:>8.0f}")
+
+
+def main_():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--count", type=int, default=8, help="端到端测试发送的图片数")
+    parser.add_argument("--uplink-mbps", type=float, default=20, help="估算上传耗时使用的上行带宽")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.CRITICAL)
+
+    work_dir = tempfile.mkdtemp(prefix="image_plugin_tf_bench_")
+    try:
+        bench_configs(work_dir, args.uplink_mbps)
+        asyncio.run(bench_end_to_end(work_dir, args.count, args.uplink_mbps))
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main_()
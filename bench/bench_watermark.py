@@ -0,0 +1,104 @@
+"""批量加水印基准：原来的整图 ImageDraw 绘制 vs 预渲染贴图局部合成（_apply_watermark）
+
+分别在当前进程中串行处理（单核吞吐）和通过 ImageWorkerPool 进程池并发处理，输出每秒处理张数。
+
+用法：python bench/bench_watermark.py [--count 40] [--processes N]
+"""
+import argparse
+import asyncio
+import io
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from PIL import Image as PILImage, ImageDraw, ImageFont  # noqa: E402
+
+from tests.stubs import load_plugin_module  # noqa: E402
+
+main = load_plugin_module()
+
+TEXT = "水印测试 watermark"
+SIZES = ((640, 480), (1920, 1080), (4000, 3000))
+FORMATS = (("JPEG", ".jpg"), ("PNG", ".png"))
+
+
+def legacy_watermark(image_path: str, output_path: str, text: str) -> str:
+    """原 _add_watermark_sync 的做法：每张图重新加载字体、测量文本，直接在原图上绘制"""
+    with PILImage.open(image_path) as img:
+        draw = ImageDraw.Draw(img)
+        font = ImageFont.load_default()
+        bbox = draw.textbbox((0, 0), text, font=font)
+        text_width, text_height = bbox[2] - bbox[0], bbox[3] - bbox[1]
+        margin = 20
+        x = img.width - text_width - margin
+        y = img.height - text_height - margin
+        draw.rectangle([(x - 5, y - 5), (x + text_width + 5, y + text_height + 5)], fill=(255, 255, 255, 100))
+        draw.text((x, y), text, font=font, fill=(0, 0, 0, 180))
+        img.save(output_path)
+    return os.path.splitext(image_path)[1]
+
+
+def make_sources(work_dir, size, fmt, ext, count):
+    """生成 count 张带渐变内容的测试图片（纯色图编码过快，不具代表性）"""
+    base = PILImage.linear_gradient("L").resize(size).convert("RGB")
+    paths = []
+    for i in range(count):
+        image = base.rotate(i * 7, expand=False)
+        buffer = io.BytesIO()
+        image.save(buffer, fmt)
+        path = os.path.join(work_dir, f"src_{i}{ext}")
+        with open(path, "wb") as f:
+            f.write(buffer.getvalue())
+        paths.append(path)
+    return paths
+
+
+def bench_serial(func, paths, out_dir):
+    started = time.perf_counter()
+    for i, path in enumerate(paths):
+        func(path, os.path.join(out_dir, f"out_{i}{os.path.splitext(path)[1]}"))
+    return len(paths) / (time.perf_counter() - started)
+
+
+async def bench_pool(pool, paths, out_dir):
+    # 先处理一张，排除进程启动时间
+    await pool.run(main._apply_watermark, paths[0], os.path.join(out_dir, "warmup" + os.path.splitext(paths[0])[1]), TEXT, "")
+    started = time.perf_counter()
+    await asyncio.gather(*(
+        pool.run(main._apply_watermark, path, os.path.join(out_dir, f"pool_{i}{os.path.splitext(path)[1]}"), TEXT, "")
+        for i, path in enumerate(paths)
+    ))
+    return len(paths) / (time.perf_counter() - started)
+
+
+def main_():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--count", type=int, default=40, help="每种尺寸/格式处理的图片数")
+    parser.add_argument("--processes", type=int, default=os.cpu_count() or 1, help="进程池大小")
+    args = parser.parse_args()
+
+    work_dir = tempfile.mkdtemp(prefix="image_plugin_wm_bench_")
+    pool = main.ImageWorkerPool(args.processes)
+    print(f"CPU {os.cpu_count()} 核, 进程池 {args.processes} 个进程, 每组 {args.count} 张")
+    print(f"{'尺寸':>10} {'格式':>5} {'原实现 张/s':>12} {'新实现 张/s':>12} {f'进程池x{args.processes} 张/s':>16}")
+    try:
+        for size in SIZES:
+            for fmt, ext in FORMATS:
+                paths = make_sources(work_dir, size, fmt, ext, args.count)
+                old = bench_serial(lambda src, dst: legacy_watermark(src, dst, TEXT), paths, work_dir)
+                new = bench_serial(lambda src, dst: main._apply_watermark(src, dst, TEXT, ""), paths, work_dir)
+                pooled = asyncio.run(bench_pool(pool, paths, work_dir))
+                print(f"{size[0]}x{size[1]:<5} {fmt:>5} {old:>12.1f} {new:>12.1f} {pooled:>16.1f}")
+                for path in paths:
+                    os.remove(path)
+    finally:
+        pool.shutdown()
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main_()
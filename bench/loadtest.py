@@ -0,0 +1,156 @@
+"""ImageResponsePlugin 压测
+
+在替身 AstrBot 环境中创建插件实例，从本地图片服务器（可配置延迟和失败率）取图，
+按固定速率回放合成的消息流，输出吞吐量、回复延迟分位数、内存占用和运行目录磁盘占用。
+
+用法：
+    python bench/loadtest.py --rate 50 --duration 20 --latency 0.05 --failure-rate 0.05
+    python bench/loadtest.py --watermark 测试水印 --config '{"prefetch_depth": 0}'
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import random
+import resource
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from tests.image_server import ImageServer, make_images  # noqa: E402
+from tests.stubs import AstrMessageEvent, collect, make_plugin  # noqa: E402
+
+
+def percentile(sorted_values, q):
+    if not sorted_values:
+        return 0.0
+    return sorted_values[min(len(sorted_values) - 1, int(q * len(sorted_values)))]
+
+
+def current_rss_mb():
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 1048576
+    except OSError:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def dir_usage(path):
+    total = count = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            try:
+                total += os.path.getsize(os.path.join(root, name))
+                count += 1
+            except OSError:
+                pass
+    return total, count
+
+
+async def replay(plugin, args, keywords):
+    """按固定速率发送消息，返回 (回复延迟列表, 有图回复数, 无图回复数)"""
+    latencies = []
+    delivered = empty = 0
+
+    async def one(event):
+        nonlocal delivered, empty
+        started = time.perf_counter()
+        results = await collect(plugin.keyword_handler(event))
+        if not results:
+            return
+        latencies.append((time.perf_counter() - started) * 1000)
+        if any(result.image for result in results):
+            delivered += 1
+        else:
+            empty += 1
+
+    tasks = []
+    interval = 1.0 / args.rate
+    start = time.perf_counter()
+    total = int(args.rate * args.duration)
+    for i in range(total):
+        # 按计划时间发送，处理落后时不补发间隔
+        delay = start + i * interval - time.perf_counter()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        if random.random() < args.trigger_ratio:
+            text = f"来张{random.choice(keywords)}"
+        else:
+            text = "普通聊天消息" * random.randint(1, 5)
+        event = AstrMessageEvent(
+            text,
+            sender_id=str(random.randrange(args.users)),
+            group_id=str(random.randrange(args.groups)),
+        )
+        tasks.append(asyncio.create_task(one(event)))
+    await asyncio.gather(*tasks)
+    return latencies, delivered, empty
+
+
+async def run(args):
+    work_dir = tempfile.mkdtemp(prefix="image_plugin_bench_")
+    tu_dir = os.path.join(work_dir, "tu")
+    os.makedirs(tu_dir)
+    with ImageServer(args.latency, args.failure_rate, make_images(8, (args.width, args.height))) as server:
+        with open(os.path.join(tu_dir, "bench.txt"), "w", encoding="utf-8") as f:
+            f.writelines(f"{server.url}/img/{i}.jpg\n" for i in range(args.urls))
+        config = {
+            "external_api": f"{server.url}/api",
+            "watermark_text": args.watermark,
+            "user_rate_per_minute": 0,
+            "group_rate_per_minute": 0,
+        }
+        config.update(json.loads(args.config))
+        plugin = make_plugin(work_dir, tu_dir=tu_dir, **config)
+        keywords = plugin.keyword_matcher.keywords
+
+        rss_before = current_rss_mb()
+        started = time.perf_counter()
+        latencies, delivered, empty = await replay(plugin, args, keywords)
+        elapsed = time.perf_counter() - started
+        stats = [result.value for result in await collect(plugin.stats_command(AstrMessageEvent("")))]
+        await plugin.terminate()
+
+        latencies.sort()
+        disk_bytes, disk_files = dir_usage(work_dir)
+        print(f"消息 {int(args.rate * args.duration)} 条, 用时 {elapsed:.1f}s")
+        print(f"回复 {len(latencies)} 次 (有图 {delivered}, 无图 {empty}), 吞吐 {len(latencies) / elapsed:.1f} 次/s")
+        print(
+            f"回复延迟 p50 {percentile(latencies, 0.5):.0f}ms, p95 {percentile(latencies, 0.95):.0f}ms, "
+            f"p99 {percentile(latencies, 0.99):.0f}ms, 最大 {latencies[-1] if latencies else 0:.0f}ms"
+        )
+        print(f"内存 RSS {rss_before:.0f}MB -> {current_rss_mb():.0f}MB")
+        print(f"运行目录 {disk_files} 个文件, {disk_bytes / 1048576:.1f}MB ({work_dir})")
+        print(f"图片服务器请求: {dict(server.requests)}")
+        print("\n".join(stats))
+    if not args.keep:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rate", type=float, default=20, help="每秒消息数")
+    parser.add_argument("--duration", type=float, default=10, help="回放时长（秒）")
+    parser.add_argument("--trigger-ratio", type=float, default=0.3, help="包含关键词的消息比例")
+    parser.add_argument("--groups", type=int, default=10, help="群数量")
+    parser.add_argument("--users", type=int, default=200, help="用户数量")
+    parser.add_argument("--urls", type=int, default=5000, help="链接池中的URL数量")
+    parser.add_argument("--latency", type=float, default=0.05, help="图片服务器响应延迟（秒）")
+    parser.add_argument("--failure-rate", type=float, default=0.0, help="图片服务器失败率")
+    parser.add_argument("--width", type=int, default=1280, help="测试图片宽度")
+    parser.add_argument("--height", type=int, default=960, help="测试图片高度")
+    parser.add_argument("--watermark", default="", help="水印文字（留空不加水印）")
+    parser.add_argument("--config", default="{}", help="额外的插件配置（JSON）")
+    parser.add_argument("--keep", action="store_true", help="保留运行目录（默认结束后删除）")
+    parser.add_argument("--verbose", action="store_true", help="输出插件日志")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO if args.verbose else logging.CRITICAL)
+    asyncio.run(run(args))
+
+
+if __name__ == "__main__":
+    main()
@@ -5,18 +5,1641 @@ from astrbot.api import logger
 from astrbot.api import AstrBotConfig
 import httpx
 import json
+import re
 import asyncio
 import os
 import random
 import time
-from typing import List, Dict, Set, Optional
+from typing import List, Dict, Set, Tuple, Deque, Callable, Awaitable, Optional
 from PIL import Image as PILImage, ImageDraw, ImageFont
 import aiofiles
 import tempfile
-import shutil
+from array import array
+from collections import OrderedDict, deque
+import hashlib
+import io
+import sqlite3
+from bisect import bisect_left
+from urllib.parse import urlsplit
+from functools import lru_cache
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+
+# 常见图片格式的文件头，用于判断下载内容的真实格式
+_IMAGE_SIGNATURES = (
+    (b'\x89PNG\r\n\x1a\n', '.png'),
+    (b'\xff\xd8\xff', '.jpg'),
+    (b'GIF87a', '.gif'),
+    (b'GIF89a', '.gif'),
+    (b'BM', '.bmp'),
+)
+
+_IMAGE_CONTENT_TYPES = {
+    'image/png': '.png',
+    'image/jpeg': '.jpg',
+    'image/gif': '.gif',
+    'image/webp': '.webp',
+    'image/bmp': '.bmp',
+    'image/avif': '.avif',
+}
+
+
+def _sniff_image_ext(head: bytes, content_type: str = "") -> Optional[str]:
+    """根据文件头（其次是Content-Type）判断图片扩展名，不是图片时返回None"""
+    for signature, ext in _IMAGE_SIGNATURES:
+        if head.startswith(signature):
+            return ext
+    if head[:4] == b'RIFF' and head[8:12] == b'WEBP':
+        return '.webp'
+    return _IMAGE_CONTENT_TYPES.get(content_type.split(';', 1)[0].strip().lower())
+
+
+@lru_cache(maxsize=32)
+def _load_watermark_font(font_path: str, font_size: int):
+    """按 (字体, 字号) 缓存已加载的字体，font_path 为空时使用默认字体"""
+    if font_path:
+        try:
+            return ImageFont.truetype(font_path, font_size)
+        except Exception as e:
+            logger.error(f"加载水印字体失败 {font_path}: {e}")
+    return ImageFont.load_default()
+
+
+@lru_cache(maxsize=64)
+def _render_watermark_overlay(text: str, font_path: str, font_size: int) -> PILImage.Image:
+    """按 (文本, 字体, 字号) 缓存预渲染的RGBA水印贴图：半透明白底加半透明黑字"""
+    font = _load_watermark_font(font_path, font_size)
+    padding = 5
+    try:
+        left, top, right, bottom = ImageDraw.Draw(PILImage.new('RGBA', (1, 1))).textbbox((0, 0), text, font=font)
+    except Exception:
+        # 降级处理
+        left, top, right, bottom = 0, 0, 100, 20
+
+    overlay = PILImage.new('RGBA', (right - left + padding * 2 + 1, bottom - top + padding * 2 + 1), (0, 0, 0, 0))
+    draw = ImageDraw.Draw(overlay)
+    draw.rectangle([(0, 0), (overlay.width - 1, overlay.height - 1)], fill=(255, 255, 255, 100))
+    draw.text((padding - left, padding - top), text, font=font, fill=(0, 0, 0, 180))
+    return overlay
+
+
+def _apply_watermark(image_path: str, output_path: str, text: str, font_path: str) -> str:
+    """在图片右下角合成水印并保存到 output_path，返回输出文件的扩展名
+
+    定义在模块级以便在进程池中执行；字体和贴图缓存在每个进程内各自生效。
+    """
+    with PILImage.open(image_path) as img:
+        font_size = max(10, min(30, img.height // 20)) if font_path else 0
+        overlay = _render_watermark_overlay(text, font_path, font_size)
+
+        # 水印位置：右下角，带边距；放不下时去掉该方向的边距，图片比水印还小时裁掉超出部分
+        margin = 15
+        x = img.width - overlay.width - margin
+        y = img.height - overlay.height - margin
+        if x < 0:
+            x = img.width - overlay.width
+        if y < 0:
+            y = img.height - overlay.height
+        if x < 0 or y < 0:
+            overlay = overlay.crop((max(0, -x), max(0, -y), overlay.width, overlay.height))
+            x, y = max(0, x), max(0, y)
+        box = (x, y, x + overlay.width, y + overlay.height)
+
+        fmt = img.format
+        if img.mode not in ('RGB', 'RGBA'):
+            keep_alpha = ('A' in img.mode or 'transparency' in img.info) and fmt not in ('JPEG', 'BMP')
+            img = img.convert('RGBA' if keep_alpha else 'RGB')
+
+        # 只在水印覆盖的区域内转为RGBA做alpha合成，半透明颜色才会真正生效
+        region = img.crop(box).convert('RGBA')
+        region.alpha_composite(overlay)
+        img.paste(region.convert(img.mode), box)
+        img.save(output_path, format=fmt)
+    return os.path.splitext(image_path)[1]
+
+
+# 压缩后输出格式: (Pillow格式名, 扩展名)
+_TRANSFORM_FORMATS = {
+    'JPEG': ('JPEG', '.jpg'),
+    'WEBP': ('WEBP', '.webp'),
+    'PNG': ('PNG', '.png'),
+}
+
+
+def _encode_image(img: PILImage.Image, fmt: str, quality: int) -> bytes:
+    buffer = io.BytesIO()
+    # JPEG/WEBP 只从保存参数读取色彩配置，需要显式传入
+    params = {'icc_profile': img.info['icc_profile']} if img.info.get('icc_profile') else {}
+    if fmt == 'JPEG':
+        img.save(buffer, format=fmt, quality=quality, optimize=True, progressive=True, **params)
+    elif fmt == 'WEBP':
+        img.save(buffer, format=fmt, quality=quality, method=4, **params)
+    else:
+        img.save(buffer, format=fmt, optimize=True, **params)
+    return buffer.getvalue()
+
+
+def _transform_image(image_path: str, output_path: str, max_dimension: int,
+                     target_format: str, quality: int, max_bytes: int) -> Optional[str]:
+    """缩小并重新编码图片，不保留EXIF等元数据，返回输出文件的扩展名
+
+    超出 max_bytes 时先逐步降低质量，再逐步缩小尺寸。
+    动图、无法处理的格式，或处理后没有变小时返回None，表示直接使用原图。
+    """
+    source_size = os.path.getsize(image_path)
+    with PILImage.open(image_path) as img:
+        if getattr(img, 'is_animated', False):
+            return None
+        fmt, ext = _TRANSFORM_FORMATS.get((target_format or img.format or '').upper(), (None, None))
+        if fmt is None:
+            return None
+
+        img.load()
+        icc_profile = img.info.get('icc_profile')
+        resized = False
+        if max_dimension and max(img.size) > max_dimension:
+            img.thumbnail((max_dimension, max_dimension), PILImage.LANCZOS)
+            resized = True
+
+        if fmt == 'JPEG' and img.mode != 'RGB':
+            # JPEG不支持透明通道，透明部分铺白底
+            rgba = img.convert('RGBA')
+            img = PILImage.new('RGB', rgba.size, (255, 255, 255))
+            img.paste(rgba, mask=rgba.getchannel('A'))
+        elif img.mode not in ('RGB', 'RGBA', 'L', 'LA', 'P'):
+            img = img.convert('RGBA' if 'A' in img.mode else 'RGB')
+
+        # 编码时 Pillow 会写回 img.info 中的注释等元数据，只保留色彩配置和调色板透明色
+        info = {'icc_profile': icc_profile} if icc_profile else {}
+        if 'transparency' in img.info:
+            info['transparency'] = img.info['transparency']
+        img.info = info
+
+        data = _encode_image(img, fmt, quality)
+        while max_bytes and len(data) > max_bytes and quality > 40 and fmt != 'PNG':
+            quality -= 10
+            data = _encode_image(img, fmt, quality)
+        while max_bytes and len(data) > max_bytes and min(img.size) > 256:
+            img = img.resize((img.width * 4 // 5, img.height * 4 // 5), PILImage.LANCZOS)
+            resized = True
+            data = _encode_image(img, fmt, quality)
+
+    same_format = ext == os.path.splitext(image_path)[1]
+    if not resized and same_format and len(data) >= source_size:
+        return None
+    with open(output_path, 'wb') as f:
+        f.write(data)
+    return ext
+
+
+class ImageWorkerPool:
+    """图片处理执行器
+
+    processes > 0 时在进程池中执行水印、压缩等图片处理，解码/绘制/编码不再占用主进程的GIL；
+    否则在线程中执行。进程池异常时自动回退到线程。
+    """
+
+    def __init__(self, processes: int):
+        self.processes = processes
+        self._pool: Optional[ProcessPoolExecutor] = None
+
+    async def run(self, func: Callable, *args):
+        """执行模块级的图片处理函数（需可被pickle）"""
+        if self.processes > 0:
+            if self._pool is None:
+                self._pool = ProcessPoolExecutor(max_workers=self.processes)
+            try:
+                return await asyncio.get_running_loop().run_in_executor(self._pool, func, *args)
+            except BrokenProcessPool:
+                logger.error("图片处理进程池异常，本次改为在线程中处理")
+                self._pool = None
+        return await asyncio.to_thread(func, *args)
+
+    def shutdown(self):
+        if self._pool is not None:
+            self._pool.shutdown(wait=False, cancel_futures=True)
+            self._pool = None
+
+
+class KeywordMatcher:
+    """多关键词匹配器（Aho-Corasick 自动机）
+
+    只在插件初始化和重载配置时构建，匹配时对消息做一次扫描，
+    返回配置顺序中最靠前（优先级最高）的命中关键词。
+    """
+
+    # 关键词较少时逐个做子串判断（C实现）比逐字符走自动机更快
+    LINEAR_SCAN_THRESHOLD = 32
+
+    def __init__(self, keywords: List[str]):
+        self.keywords: List[str] = []
+        self._lowered: List[str] = []
+        seen = set()
+        for keyword in keywords:
+            lowered = str(keyword).strip().lower()
+            if not lowered or lowered in seen:
+                continue
+            seen.add(lowered)
+            self.keywords.append(keyword)
+            self._lowered.append(lowered)
+
+        self._use_automaton = len(self._lowered) > self.LINEAR_SCAN_THRESHOLD
+        if self._use_automaton:
+            self._build()
+
+    def _build(self):
+        """构建 goto / fail 表，并把每个状态可输出的最高优先级预先算好"""
+        no_match = len(self._lowered)
+        goto: List[Dict[str, int]] = [{}]
+        best: List[int] = [no_match]
+
+        for priority, word in enumerate(self._lowered):
+            state = 0
+            for ch in word:
+                nxt = goto[state].get(ch)
+                if nxt is None:
+                    nxt = len(goto)
+                    goto[state][ch] = nxt
+                    goto.append({})
+                    best.append(no_match)
+                state = nxt
+            best[state] = min(best[state], priority)
+
+        fail = [0] * len(goto)
+        queue = list(goto[0].values())
+        head = 0
+        while head < len(queue):
+            state = queue[head]
+            head += 1
+            for ch, nxt in goto[state].items():
+                queue.append(nxt)
+                f = fail[state]
+                while f and ch not in goto[f]:
+                    f = fail[f]
+                fail[nxt] = goto[f].get(ch, 0)
+                best[nxt] = min(best[nxt], best[fail[nxt]])
+
+        self._goto = goto
+        self._fail = fail
+        self._best = best
+
+    def match(self, text: str) -> Optional[str]:
+        """返回消息中命中的优先级最高的关键词，未命中返回None（text需已转小写）"""
+        if not self._lowered:
+            return None
+
+        if not self._use_automaton:
+            for index, lowered in enumerate(self._lowered):
+                if lowered in text:
+                    return self.keywords[index]
+            return None
+
+        goto, fail, best = self._goto, self._fail, self._best
+        no_match = len(self._lowered)
+        found = no_match
+        state = 0
+        for ch in text:
+            while state and ch not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(ch, 0)
+            if best[state] < found:
+                found = best[state]
+                if found == 0:
+                    break
+        return self.keywords[found] if found < no_match else None
+
+
+
+class KeywordRouter:
+    """关键词到图片来源的路由表
+
+    由配置中的路由规则一次性编译，每行格式为 `关键词 = 来源, 来源*权重, ...`：
+    - 关键词部分可用逗号分隔多个别名，别名会加入触发关键词；
+      以 `re:` 开头时整体作为正则表达式（忽略大小写），只用于给已有的触发关键词指定来源，不会新增触发关键词；
+    - 来源可以是 TXT 文件名（或 `txt:文件名`/绝对路径）、`local`（配置的本地目录）、
+      `local:目录路径` 或 `api`，`*数字` 指定权重，默认为1。
+    触发关键词在构建时就按正则规则（按配置顺序，各自编译）解析好，查询只需一次字典查找；
+    无效的正则只跳过该条规则。重载配置时整体替换为新的路由表，处理中的请求继续使用旧表。
+    """
+
+    SPLIT = re.compile(r"[,，]")
+
+    def __init__(self, rules: List[str], keywords: List[str] = ()):
+        self._exact: Dict[str, Tuple[Tuple[Tuple[str, str], float], ...]] = {}  # {小写关键词: 路由}
+        patterns: List[Tuple[str, re.Pattern, Tuple[Tuple[Tuple[str, str], float], ...]]] = []  # [(原文, 正则, 路由)]
+        self.keywords: List[str] = []  # 规则中出现的别名，按配置顺序，也作为触发关键词
+        for rule in rules:
+            aliases, sep, sources = str(rule).rpartition("=")
+            aliases = aliases.strip()
+            route = self._parse_sources(sources) if sep else ()
+            if not aliases or not route:
+                logger.error(f"无效的关键词路由规则: {rule}")
+                continue
+            if aliases.startswith("re:"):
+                try:
+                    patterns.append((aliases[3:], re.compile(aliases[3:], re.IGNORECASE), route))
+                except re.error as e:
+                    logger.error(f"关键词路由的正则表达式无效 {aliases[3:]}: {e}")
+                continue
+            for alias in self.SPLIT.split(aliases):
+                alias = alias.strip()
+                if alias and alias.lower() not in self._exact:
+                    self._exact[alias.lower()] = route
+                    self.keywords.append(alias)
+
+        # 正则规则只对触发关键词生效，关键词在构建时就确定，逐个解析后并入字典
+        matched = set()
+        for keyword in keywords:
+            if keyword.lower() in self._exact:
+                continue
+            for text, pattern, route in patterns:
+                if pattern.search(keyword):
+                    self._exact[keyword.lower()] = route
+                    matched.add(text)
+                    break
+        for text, _, _ in patterns:
+            if text not in matched:
+                logger.warning(f"关键词路由的正则表达式没有匹配任何触发关键词，不会生效: {text}")
+
+    @classmethod
+    def _parse_sources(cls, text: str) -> Tuple[Tuple[Tuple[str, str], float], ...]:
+        """解析来源列表为 ((类型, 目标), 权重) 元组"""
+        route = []
+        for item in cls.SPLIT.split(text):
+            item = item.strip()
+            weight = 1.0
+            name, star, weight_text = item.rpartition("*")
+            if star:
+                try:
+                    weight = float(weight_text)
+                    item = name.strip()
+                except ValueError:
+                    pass
+            if not item or weight <= 0:
+                continue
+            if item == "api" or item == "local":
+                route.append(((item, ""), weight))
+            elif item.startswith("local:"):
+                route.append((("local", item[6:].strip()), weight))
+            else:
+                route.append((("txt", item[4:].strip() if item.startswith("txt:") else item), weight))
+        return tuple(route)
+
+    def lookup(self, keyword: str) -> Optional[Tuple[Tuple[Tuple[str, str], float], ...]]:
+        """返回关键词对应的路由，没有规则时返回None"""
+        return self._exact.get(keyword.lower())
+
+    def targets(self, kind: str) -> Set[str]:
+        """所有规则中某类来源的目标"""
+        return {target for route in self._exact.values() for (source_kind, target), _ in route if source_kind == kind}
+
+    @staticmethod
+    def order(route: Tuple[Tuple[Tuple[str, str], float], ...]) -> List[Tuple[str, str]]:
+        """按权重随机排列路由中的来源（不放回加权抽样），依次作为首选和后备"""
+        keyed = sorted(route, key=lambda item: random.random() ** (1.0 / item[1]), reverse=True)
+        return [source for source, _ in keyed]
+
+class UrlPoolIndex:
+    """TXT图片链接池索引
+
+    启动时一次性读入tu目录下所有TXT文件，按文件名（不含.txt后缀）索引；
+    之后按文件的 mtime/size 增量刷新，只重新读取发生变化的文件。
+    配置中的绝对路径文件以绝对路径作为索引键。
+    """
+
+    # 两次检查文件变化之间的最小间隔（秒）
+    REFRESH_INTERVAL = 5.0
+
+    def __init__(self, tu_dir: str):
+        self.tu_dir = tu_dir
+        self.pools: Dict[str, Tuple[str, ...]] = {}   # {索引键: 链接元组}
+        self._paths: Dict[str, str] = {}              # {索引键: 文件路径}
+        self._signatures: Dict[str, Tuple[float, int]] = {}  # {索引键: (mtime, size)}
+        self._lower_keys: Dict[str, str] = {}         # {小写文件名: 索引键}
+        self._external: Set[str] = set()              # 额外跟踪的绝对路径文件
+        self._last_refresh = 0.0
+        self._refreshing: Optional[asyncio.Task] = None
+
+    @staticmethod
+    def _read_urls(path: str) -> Tuple[str, ...]:
+        with open(path, 'r', encoding='utf-8') as f:
+            return tuple(line.strip() for line in f if line.strip())
+
+    def _scan(self) -> Dict[str, str]:
+        """列出当前应当被索引的文件 {索引键: 文件路径}"""
+        files = {}
+        if os.path.isdir(self.tu_dir):
+            with os.scandir(self.tu_dir) as entries:
+                for entry in entries:
+                    if entry.name.endswith('.txt') and entry.is_file():
+                        files[os.path.splitext(entry.name)[0]] = entry.path
+        for path in self._external:
+            if os.path.isfile(path):
+                files[path] = path
+        return files
+
+    def refresh_sync(self):
+        """同步刷新索引，只重新读取新增或 mtime/size 变化的文件"""
+        files = self._scan()
+
+        for key in list(self.pools):
+            if key not in files:
+                self.pools.pop(key, None)
+                self._paths.pop(key, None)
+                self._signatures.pop(key, None)
+                logger.info(f"图片链接文件已移除: {key}")
+
+        for key, path in files.items():
+            try:
+                stat = os.stat(path)
+                signature = (stat.st_mtime, stat.st_size)
+                if self._signatures.get(key) == signature:
+                    continue
+                self.pools[key] = self._read_urls(path)
+                self._paths[key] = path
+                self._signatures[key] = signature
+                logger.info(f"已加载图片链接文件 {path}: {len(self.pools[key])} 个URL")
+            except Exception as e:
+                logger.error(f"加载图片链接文件失败 {path}: {e}")
+
+        self._lower_keys = {key.lower(): key for key in self.pools}
+        self._last_refresh = time.monotonic()
+
+    async def refresh(self):
+        """在线程中增量刷新索引，距离上次刷新不足 REFRESH_INTERVAL 时直接返回"""
+        if time.monotonic() - self._last_refresh < self.REFRESH_INTERVAL:
+            return
+        if self._refreshing is None or self._refreshing.done():
+            self._refreshing = asyncio.create_task(asyncio.to_thread(self.refresh_sync))
+        await asyncio.shield(self._refreshing)
+
+    def watch(self, path: str):
+        """额外跟踪一个绝对路径的TXT文件，下次刷新时加载"""
+        if path not in self._external:
+            self._external.add(path)
+            self._last_refresh = 0.0
+
+    def find(self, name: str) -> Optional[str]:
+        """按文件名（忽略大小写，可带.txt后缀）查找索引键"""
+        if name.endswith('.txt'):
+            name = name[:-4]
+        return self._lower_keys.get(name.lower())
+
+    def keys(self) -> List[str]:
+        return list(self.pools)
+
+    def get(self, key: str) -> Tuple[str, ...]:
+        return self.pools.get(key, ())
+
+
+class LocalImageIndex:
+    """本地图片目录索引
+
+    在线程中扫描目录（可递归）建立图片文件列表，之后按目录的 mtime 增量刷新：
+    文件增删会改变所在目录的 mtime，只需重新列出发生变化的目录。
+    首次扫描完成后，刷新在后台进行，取用时不等待。
+    """
+
+    IMAGE_EXTENSIONS = {'.jpg', '.jpeg', '.png', '.gif', '.bmp'}
+    # 两次检查目录变化之间的最小间隔（秒）
+    REFRESH_INTERVAL = 5.0
+
+    def __init__(self, root: str, recursive: bool = False):
+        self.root = root
+        self.recursive = recursive
+        self.files: Tuple[str, ...] = ()
+        # {目录: (mtime, 该目录下的图片文件, 子目录)}
+        self._dirs: Dict[str, Tuple[float, Tuple[str, ...], Tuple[str, ...]]] = {}
+        self._last_refresh = 0.0
+        self._refreshing: Optional[asyncio.Task] = None
+        self._ready = False
+
+    def _list_dir(self, path: str) -> Tuple[Tuple[str, ...], Tuple[str, ...]]:
+        files, subdirs = [], []
+        with os.scandir(path) as entries:
+            for entry in entries:
+                try:
+                    if self.recursive and entry.is_dir():
+                        subdirs.append(entry.path)
+                    elif os.path.splitext(entry.name)[1].lower() in self.IMAGE_EXTENSIONS and entry.is_file():
+                        files.append(entry.path)
+                except OSError:
+                    continue
+        return tuple(files), tuple(subdirs)
+
+    def refresh_sync(self) -> bool:
+        """同步刷新索引，只重新列出 mtime 变化的目录；返回文件列表是否变化"""
+        dirs = {}
+        changed = False
+        stack = [self.root] if os.path.isdir(self.root) else []
+        while stack:
+            path = stack.pop()
+            try:
+                mtime = os.stat(path).st_mtime
+                known = self._dirs.get(path)
+                if known is not None and known[0] == mtime:
+                    dirs[path] = known
+                else:
+                    dirs[path] = (mtime,) + self._list_dir(path)
+                    changed = True
+            except OSError as e:
+                logger.error(f"扫描本地图片目录失败 {path}: {e}")
+                continue
+            stack.extend(dirs[path][2])
+
+        if changed or len(dirs) != len(self._dirs):
+            self._dirs = dirs
+            self.files = tuple(file for entry in dirs.values() for file in entry[1])
+            logger.info(f"本地图片目录索引已更新: {len(self.files)} 张图片")
+            changed = True
+        self._last_refresh = time.monotonic()
+        self._ready = True
+        return changed
+
+    async def refresh(self):
+        """在线程中刷新索引：首次扫描需等待完成，之后到达间隔时在后台刷新"""
+        if self._ready and time.monotonic() - self._last_refresh < self.REFRESH_INTERVAL:
+            return
+        if self._refreshing is None or self._refreshing.done():
+            self._refreshing = asyncio.create_task(asyncio.to_thread(self.refresh_sync))
+        if not self._ready:
+            await asyncio.shield(self._refreshing)
+
+    def cancel(self):
+        if self._refreshing is not None:
+            self._refreshing.cancel()
+
+
+class NonRepeatingSampler:
+    """无重复随机采样器
+
+    可选下标保存在数组中，抽取时随机取一个位置并与末尾交换后弹出（O(1)）；
+    被抽中的下标按过期时间进入队列，超过去重窗口后放回可选数组。
+    所有链接都在窗口内抽过时退化为允许重复的随机选择。
+    过期队列用两个定长元素数组保存，每条记录16字节，总量不超过链接池大小。
+    """
+
+    def __init__(self, items: Tuple[str, ...], window: float):
+        self.items = items
+        self.window = window
+        self._available = array('l', range(len(items)))
+        # 过期队列：_expire_at[i] 时刻放回下标 _expire_index[i]，按时间递增；_head 之前的记录已出队
+        self._expire_at = array('d')
+        self._expire_index = array('l')
+        self._head = 0
+
+    def release_expired(self, now: float) -> int:
+        """把超过去重窗口的下标放回可选数组，返回放回的数量"""
+        expire_at, expire_index, available = self._expire_at, self._expire_index, self._available
+        start = head = self._head
+        while head < len(expire_at) and expire_at[head] <= now:
+            available.append(expire_index[head])
+            head += 1
+        self._head = head
+        # 已出队部分过半时压缩，均摊O(1)
+        if head > 1024 and head * 2 > len(expire_at):
+            del expire_at[:head]
+            del expire_index[:head]
+            self._head = 0
+        return head - start
+
+    def pick(self, now: Optional[float] = None) -> Tuple[Optional[str], bool]:
+        """抽取一个链接，返回 (链接, 是否为重复发送)；池为空时返回 (None, False)"""
+        if not self.items:
+            return None, False
+        if now is None:
+            now = time.time()
+        self.release_expired(now)
+
+        available = self._available
+        if not available:
+            return random.choice(self.items), True
+
+        pos = random.randrange(len(available))
+        index = available[pos]
+        available[pos] = available[-1]
+        available.pop()
+        self._expire_at.append(now + self.window)
+        self._expire_index.append(index)
+        return self.items[index], False
+
+    def rebuild(self, items: Tuple[str, ...]):
+        """链接列表变化后重建，保留仍存在的链接的去重记录"""
+        positions = {url: index for index, url in enumerate(items)}
+        expire_at, expire_index = array('d'), array('l')
+        taken = set()
+        for i in range(self._head, len(self._expire_at)):
+            index = positions.get(self.items[self._expire_index[i]])
+            if index is not None and index not in taken:
+                taken.add(index)
+                expire_at.append(self._expire_at[i])
+                expire_index.append(index)
+        self.items = items
+        self._expire_at, self._expire_index, self._head = expire_at, expire_index, 0
+        self._available = array('l', (i for i in range(len(items)) if i not in taken))
+
+    @property
+    def available_count(self) -> int:
+        return len(self._available)
+
+
+class PathPins:
+    """正在使用（发送中）的文件路径引用计数，缓存淘汰时跳过这些文件"""
+
+    def __init__(self):
+        self._counts: Dict[str, int] = {}
+
+    def pin(self, path: str):
+        self._counts[path] = self._counts.get(path, 0) + 1
+
+    def unpin(self, path: str):
+        count = self._counts.get(path, 0) - 1
+        if count > 0:
+            self._counts[path] = count
+        else:
+            self._counts.pop(path, None)
+
+    def __contains__(self, path: str) -> bool:
+        return path in self._counts
+
+
+class TempJanitor:
+    """临时目录清理
+
+    插件自身已不再向临时目录写文件（下载图片和派生图片都保存在缓存目录中），
+    这里只按存放时间清理旧版本遗留的文件，以及其他代码经 tempfile 写入该目录的文件。
+    扫描和删除在线程中进行，每轮最多删除 MAX_REMOVALS 个文件；随插件分发的文件不会被删除。
+    """
+
+    MAX_REMOVALS = 500
+
+    def __init__(self, temp_dir: str, max_age: float, keep: Tuple[str, ...] = ()):
+        self.temp_dir = temp_dir
+        self.max_age = max_age
+        self.keep = set(keep)
+
+    def sweep_sync(self) -> Tuple[int, int]:
+        """删除超过存放时间的文件，返回 (删除文件数, 释放字节数)"""
+        cutoff = time.time() - self.max_age
+        removed = freed = 0
+        try:
+            with os.scandir(self.temp_dir) as entries:
+                for entry in entries:
+                    if removed >= self.MAX_REMOVALS:
+                        break
+                    if entry.name in self.keep:
+                        continue
+                    try:
+                        if not entry.is_file():
+                            continue
+                        stat = entry.stat()
+                        if stat.st_mtime > cutoff:
+                            continue
+                        os.remove(entry.path)
+                    except OSError:
+                        continue
+                    removed += 1
+                    freed += stat.st_size
+        except FileNotFoundError:
+            pass
+        return removed, freed
+
+
+class ImageCache:
+    """以URL哈希为键的磁盘图片缓存
+
+    原图文件名为 <sha1(url)><扩展名>；由原图生成的派生图片（如加水印后的图片）
+    文件名为 <原图键>.<派生标签><扩展名>，原图被淘汰或替换时一并删除。
+    文件 mtime 记录写入时间（用于TTL），atime 记录最近一次命中（用于LRU），
+    重启后扫描目录即可恢复索引。总大小超过上限时按LRU淘汰（正在发送的图片除外），
+    超过TTL的文件在命中时失效。
+    """
+
+    def __init__(self, cache_dir: str, max_bytes: int, ttl: float, pins: Optional[PathPins] = None):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.pins = pins if pins is not None else PathPins()
+        self._entries: "OrderedDict[str, Tuple[str, int, float]]" = OrderedDict()  # {键: (路径, 大小, 写入时间)}，按LRU排列
+        self._children: Dict[str, Set[str]] = {}  # {源图片键: 派生图片键集合}
+        self._total_bytes = 0
+        self._loading: Optional[asyncio.Task] = None
+        self.evictions = 0  # 累计因超出上限淘汰的文件数，由调用方定期汇总输出日志
+
+    @staticmethod
+    def key_for(url: str) -> str:
+        return hashlib.sha1(url.encode('utf-8')).hexdigest()
+
+    def derived_key(self, source_path: str, tag: str) -> str:
+        """派生图片的键：缓存内的图片直接使用其键，其他文件按路径、修改时间和大小计算源标识"""
+        source_key = os.path.splitext(os.path.basename(source_path))[0]
+        if os.path.dirname(source_path) != self.cache_dir or source_key not in self._entries:
+            stat = os.stat(source_path)
+            source_key = self.key_for(f"{os.path.abspath(source_path)}:{stat.st_mtime_ns}:{stat.st_size}")
+        return f"{source_key}.{tag}"
+
+    def _scan_sync(self) -> List[Tuple[float, str, str, int, float]]:
+        """扫描缓存目录，删除残留的未完成文件和已过期文件"""
+        os.makedirs(self.cache_dir, exist_ok=True)
+        now = time.time()
+        found = []
+        with os.scandir(self.cache_dir) as entries:
+            for entry in entries:
+                if not entry.is_file():
+                    continue
+                stat = entry.stat()
+                expired = self.ttl and now - stat.st_mtime >= self.ttl
+                if entry.name.endswith('.part') or expired:
+                    try:
+                        os.remove(entry.path)
+                    except OSError:
+                        pass
+                    continue
+                key = os.path.splitext(entry.name)[0]
+                if len(key.split('.', 1)[0]) != 40:
+                    continue
+                found.append((stat.st_atime, key, entry.path, stat.st_size, stat.st_mtime))
+        found.sort()
+        return found
+
+    async def load(self):
+        """首次使用时在线程中扫描缓存目录恢复索引"""
+        if self._loading is None:
+            self._loading = asyncio.create_task(self._load())
+        await asyncio.shield(self._loading)
+
+    async def _load(self):
+        for _, key, path, size, created in await asyncio.to_thread(self._scan_sync):
+            if key not in self._entries:
+                self._add(key, path, size, created)
+        logger.info(f"图片缓存已加载: {len(self._entries)} 个文件, 共 {self._total_bytes / 1048576:.1f} MB")
+        await self._evict()
+
+    async def get(self, key: str) -> Optional[str]:
+        """命中时返回缓存文件路径，并刷新其LRU位置（派生图片同时刷新源图片）"""
+        await self.load()
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+
+        path, _, created = entry
+        now = time.time()
+        if self.ttl and now - created >= self.ttl:
+            await self._discard([key])
+            return None
+        try:
+            # 用 atime 记录访问时间，重启后仍能恢复LRU顺序
+            os.utime(path, (now, created))
+        except OSError:
+            await self._discard([key])
+            return None
+        self._touch(key)
+        return path
+
+    def temp_path(self, key: str) -> str:
+        """写入中的临时文件路径，与缓存文件位于同一目录以便原子重命名"""
+        return os.path.join(self.cache_dir, f"{key}.{random.randint(1000, 9999)}.part")
+
+    async def put(self, key: str, temp_path: str, ext: str) -> str:
+        """把写入完成的临时文件移入缓存，返回缓存文件路径"""
+        await self.load()
+        path = os.path.join(self.cache_dir, key + ext)
+        os.replace(temp_path, path)
+
+        # 替换旧文件时，由旧文件生成的派生图片一并失效
+        stale = [old_path for old_path in self._drop(key) if old_path != path]
+        if stale:
+            await asyncio.to_thread(self._remove_files, stale)
+
+        self._add(key, path, os.path.getsize(path), time.time())
+        await self._evict(protect=key)
+        return path
+
+    async def invalidate(self, tag_prefix: str, keep_tag: str = ""):
+        """删除标签以 tag_prefix 开头的派生图片（keep_tag 除外），用于派生参数变化后清理旧结果"""
+        stale = []
+        for key in self._entries:
+            tag = key.rsplit('.', 1)[1] if '.' in key else ""
+            if tag.startswith(tag_prefix) and tag != keep_tag:
+                stale.append(key)
+        if stale:
+            await self._discard(stale)
+            logger.info(f"已清理 {len(stale)} 个失效的派生图片")
+
+    def _add(self, key: str, path: str, size: int, created: float):
+        self._touch(key)
+        self._entries[key] = (path, size, created)
+        self._total_bytes += size
+        if '.' in key:
+            self._children.setdefault(key.rsplit('.', 1)[0], set()).add(key)
+
+    def _touch(self, key: str):
+        """把键及其所有源图片移到LRU末尾，源图片总是先于派生图片被淘汰"""
+        parts = key.split('.')
+        for i in range(1, len(parts) + 1):
+            ancestor = '.'.join(parts[:i])
+            if ancestor in self._entries:
+                self._entries.move_to_end(ancestor)
+
+    def _drop(self, key: str) -> List[str]:
+        """从索引中移除键及其派生图片，返回需要删除的文件路径"""
+        paths = []
+        pending = [key]
+        while pending:
+            current = pending.pop()
+            entry = self._entries.pop(current, None)
+            if entry:
+                self._total_bytes -= entry[1]
+                paths.append(entry[0])
+            pending.extend(self._children.pop(current, ()))
+            if '.' in current:
+                parent = current.rsplit('.', 1)[0]
+                siblings = self._children.get(parent)
+                if siblings is not None:
+                    siblings.discard(current)
+                    if not siblings:
+                        del self._children[parent]
+        return paths
+
+    async def _discard(self, keys: List[str]):
+        paths = [path for key in keys for path in self._drop(key)]
+        if paths:
+            await asyncio.to_thread(self._remove_files, paths)
+
+    async def _evict(self, protect: str = ""):
+        """总大小超过上限时按LRU淘汰，至少保留最近写入的文件及其源图片"""
+        paths = []
+        skipped = 0
+        while self._total_bytes > self.max_bytes and len(self._entries) - skipped > 1:
+            oldest = next(iter(self._entries))
+            if protect and (protect + '.').startswith(oldest + '.'):
+                break
+            if self._in_use(oldest):
+                # 正在发送的图片（或由它生成的图片）暂不淘汰
+                self._entries.move_to_end(oldest)
+                skipped += 1
+                continue
+            paths.extend(self._drop(oldest))
+        if paths:
+            await asyncio.to_thread(self._remove_files, paths)
+            self.evictions += len(paths)
+            logger.debug(f"图片缓存超出上限，已淘汰 {len(paths)} 个文件")
+
+    def _in_use(self, key: str) -> bool:
+        """键或其派生图片是否正在被发送"""
+        pending = [key]
+        while pending:
+            current = pending.pop()
+            entry = self._entries.get(current)
+            if entry and entry[0] in self.pins:
+                return True
+            pending.extend(self._children.get(current, ()))
+        return False
+
+    @staticmethod
+    def _remove_files(paths: List[str]):
+        for path in paths:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+
+class LatencyHistogram:
+    """固定分桶的延迟直方图（毫秒），用于粗略估计分位数"""
+
+    BUCKETS = (0.1, 0.5, 1, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000, 30000, float('inf'))
+
+    def __init__(self):
+        self.counts = [0] * len(self.BUCKETS)
+        self.count = 0
+        self.total_ms = 0.0
+
+    def observe(self, ms: float):
+        self.counts[bisect_left(self.BUCKETS, ms)] += 1
+        self.count += 1
+        self.total_ms += ms
+
+    def percentile(self, q: float) -> float:
+        """返回第q分位数所在分桶的上界"""
+        if not self.count:
+            return 0.0
+        target = q * self.count
+        seen = 0
+        for bound, n in zip(self.BUCKETS, self.counts):
+            seen += n
+            if seen >= target:
+                return bound
+        return self.BUCKETS[-1]
+
+    def summary(self) -> str:
+        if not self.count:
+            return "暂无数据"
+        average = self.total_ms / self.count
+        return (
+            f"{self.count} 次, 平均 {average:.{0 if average >= 10 else 2}f}ms, "
+            f"p50≤{self.percentile(0.5):g}ms, p95≤{self.percentile(0.95):g}ms, p99≤{self.percentile(0.99):g}ms"
+        )
+
+
+class PipelineMetrics:
+    """回复流程的计数器和各阶段耗时直方图，可导出为 Prometheus 文本格式"""
+
+    # 各阶段在统计输出中的名称
+    STAGE_NAMES = {
+        "reply": "回复总耗时",
+        "keyword_match": "关键词匹配",
+        "source": "选取图片",
+        "download": "下载",
+        "transform": "压缩",
+        "watermark": "水印",
+        "send": "发送",
+    }
+
+    def __init__(self):
+        self.stages: Dict[str, LatencyHistogram] = {}
+        self.counters: Dict[Tuple[str, str], int] = {}  # {(计数器名, 标签): 次数}
+
+    def observe(self, stage: str, ms: float):
+        histogram = self.stages.get(stage)
+        if histogram is None:
+            histogram = self.stages[stage] = LatencyHistogram()
+        histogram.observe(ms)
+
+    def incr(self, name: str, label: str = "", n: int = 1):
+        key = (name, label)
+        self.counters[key] = self.counters.get(key, 0) + n
+
+    def count(self, name: str) -> int:
+        """计数器各标签之和"""
+        return sum(n for (counter, _), n in self.counters.items() if counter == name)
+
+    def stage_summary(self) -> List[str]:
+        return [
+            f"{self.STAGE_NAMES.get(stage, stage)}: {histogram.summary()}"
+            for stage, histogram in self.stages.items()
+        ]
+
+    @staticmethod
+    def _label_value(value: str) -> str:
+        """按 Prometheus 文本格式转义标签值中的反斜杠、双引号和换行"""
+        return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+    def prometheus(self, prefix: str = "image_response") -> str:
+        """按 Prometheus 文本格式导出全部指标"""
+        lines = []
+        for name in sorted({name for name, _ in self.counters}):
+            lines.append(f"# TYPE {prefix}_{name}_total counter")
+            for (counter, label), n in sorted(self.counters.items()):
+                if counter == name:
+                    labels = f'{{source="{self._label_value(label)}"}}' if label else ""
+                    lines.append(f"{prefix}_{name}_total{labels} {n}")
+        metric = f"{prefix}_stage_duration_ms"
+        lines.append(f"# TYPE {metric} histogram")
+        for stage, histogram in self.stages.items():
+            stage = self._label_value(stage)
+            cumulative = 0
+            for bound, n in zip(histogram.BUCKETS, histogram.counts):
+                cumulative += n
+                le = "+Inf" if bound == float('inf') else f"{bound:g}"
+                lines.append(f'{metric}_bucket{{stage="{stage}",le="{le}"}} {cumulative}')
+            lines.append(f'{metric}_sum{{stage="{stage}"}} {histogram.total_ms:.3f}')
+            lines.append(f'{metric}_count{{stage="{stage}"}} {histogram.count}')
+        return "\n".join(lines) + "\n"
+
+
+class PrefetchQueue:
+    """后台预取队列
+
+    每个图片来源（链接池或API）预先下载若干张图片放在本地，
+    取用后在后台异步补充，使回复无需等待网络。
+    预取同样经过去重采样，队列中的图片不会在去重窗口内重复；
+    队列中保存 (URL, 本地路径)，便于取用时再按发送范围确认去重。
+    """
+
+    # 单次补充中连续失败达到该次数时放弃，等下次取用再试
+    MAX_FAILURES = 3
+
+    def __init__(self, depth: int, fetch: Callable[[str], Awaitable[Optional[Tuple[str, str]]]]):
+        self.depth = depth
+        self._fetch = fetch
+        self._ready: Dict[str, Deque[Tuple[str, str]]] = {}  # {来源: 已就绪的 (URL, 图片路径)}
+        self._filling: Dict[str, asyncio.Task] = {}    # {来源: 补充任务}
+        self.hits = 0
+        self.misses = 0
+
+    def take(self, source: str) -> Optional[Tuple[str, str]]:
+        """取出一张已就绪的图片 (URL, 图片路径)（没有则返回None），并触发后台补充"""
+        if self.depth <= 0:
+            return None
+        item = None
+        ready = self._ready.get(source)
+        while ready:
+            candidate = ready.popleft()
+            if os.path.exists(candidate[1]):
+                item = candidate
+                break
+        if item:
+            self.hits += 1
+        else:
+            self.misses += 1
+        self._schedule(source)
+        return item
+
+    def _schedule(self, source: str):
+        task = self._filling.get(source)
+        if task is None or task.done():
+            self._filling[source] = asyncio.create_task(self._fill(source))
+
+    async def _fill(self, source: str):
+        ready = self._ready.setdefault(source, deque())
+        failures = 0
+        while len(ready) < self.depth and failures < self.MAX_FAILURES:
+            try:
+                item = await self._fetch(source)
+            except Exception as e:
+                logger.error(f"预取图片失败 {source}: {e}")
+                item = None
+            if item:
+                ready.append(item)
+                failures = 0
+            else:
+                failures += 1
+
+    def clear(self):
+        """取消补充任务并清空队列（已下载的文件仍保留在磁盘缓存中）"""
+        for task in self._filling.values():
+            task.cancel()
+        self._filling.clear()
+        self._ready.clear()
+
+    def ready_count(self) -> int:
+        return sum(len(ready) for ready in self._ready.values())
+
+
+class ApiBatchBuffer:
+    """外部API结果缓冲
+
+    每次请求API取回一批图片记录 (URL, 元数据) 放在内存中，回复时直接取用，
+    剩余数量不多时在后台补充，大部分API图片只需下载而不再额外请求API。
+    """
+
+    def __init__(self, batch_size: int, fetch_batch: Callable[[int], Awaitable[List[Tuple[str, dict]]]]):
+        self.batch_size = max(1, batch_size)
+        self.capacity = self.batch_size * 2
+        self.low_water = self.batch_size // 2
+        self._fetch_batch = fetch_batch
+        self._items: Deque[Tuple[str, dict]] = deque()
+        self._refilling: Optional[asyncio.Task] = None
+        self.requests = 0
+
+    async def take(self) -> Optional[Tuple[str, dict]]:
+        """取出一条图片记录，缓冲为空时等待补充完成；补充失败返回None"""
+        if not self._items:
+            await asyncio.shield(self._schedule())
+        if not self._items:
+            return None
+        item = self._items.popleft()
+        if len(self._items) <= self.low_water:
+            self._schedule()
+        return item
+
+    def _schedule(self) -> asyncio.Task:
+        if self._refilling is None or self._refilling.done():
+            self._refilling = asyncio.create_task(self._refill())
+        return self._refilling
+
+    async def _refill(self):
+        wanted = min(self.batch_size, self.capacity - len(self._items))
+        if wanted <= 0:
+            return
+        self.requests += 1
+        try:
+            records = await self._fetch_batch(wanted)
+        except Exception as e:
+            logger.error(f"请求外部API失败: {e}")
+            return
+        buffered = {url for url, _ in self._items}
+        for url, info in records:
+            if url not in buffered and len(self._items) < self.capacity:
+                buffered.add(url)
+                self._items.append((url, info))
+
+    def clear(self):
+        if self._refilling is not None:
+            self._refilling.cancel()
+            self._refilling = None
+        self._items.clear()
+
+    def __len__(self) -> int:
+        return len(self._items)
+
+
+class FairScheduler:
+    """按群/用户公平调度的并发限制器
+
+    同时处理的请求数不超过 limit；超出的请求按群排队，群之间轮转，
+    同一群内再按用户轮转，避免单个群或用户刷屏占满所有名额。
+    排队人数超过上限或等待超时时直接返回失败，由调用方回复繁忙。
+    """
+
+    def __init__(self, limit: int, max_waiting_per_group: int, max_waiting_per_user: int):
+        self.limit = limit
+        self.max_waiting_per_group = max_waiting_per_group
+        self.max_waiting_per_user = max_waiting_per_user
+        self.active = 0
+        # {群: {用户: 等待中的Future队列}}，两层都按轮转顺序排列
+        self._queues: "OrderedDict[str, OrderedDict[str, Deque[asyncio.Future]]]" = OrderedDict()
+        self._waiting: Dict[str, int] = {}  # {群: 排队人数}
+
+    async def acquire(self, group: str, user: str, timeout: float) -> bool:
+        """获取一个处理名额，排队已满或等待超时返回False"""
+        if self.active < self.limit and not self._queues:
+            self.active += 1
+            return True
+
+        users = self._queues.get(group)
+        queue = users.get(user) if users else None
+        if self._waiting.get(group, 0) >= self.max_waiting_per_group or (
+            queue is not None and len(queue) >= self.max_waiting_per_user
+        ):
+            return False
+
+        if users is None:
+            users = self._queues[group] = OrderedDict()
+        if queue is None:
+            queue = users[user] = deque()
+        future = asyncio.get_running_loop().create_future()
+        queue.append(future)
+        self._waiting[group] = self._waiting.get(group, 0) + 1
+
+        try:
+            await asyncio.wait_for(future, timeout)
+            return True
+        except asyncio.TimeoutError:
+            # 超时与 release() 转交名额可能发生在同一轮事件循环中，此时名额已属于本请求，需要归还
+            if future.done() and not future.cancelled():
+                self.release()
+            else:
+                self._discard(group, user, future)
+            return False
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                self.release()
+            else:
+                self._discard(group, user, future)
+            raise
+
+    def release(self):
+        """归还名额；有人排队时直接转交给轮转顺序中的下一个等待者"""
+        while self._queues:
+            group, users = next(iter(self._queues.items()))
+            user, queue = next(iter(users.items()))
+            future = queue.popleft()
+            self._waiting[group] -= 1
+            if queue:
+                users.move_to_end(user)
+            else:
+                del users[user]
+            if users:
+                self._queues.move_to_end(group)
+            else:
+                del self._queues[group]
+                del self._waiting[group]
+            if not future.done():
+                future.set_result(None)
+                return
+        self.active -= 1
+
+    def _discard(self, group: str, user: str, future: asyncio.Future):
+        users = self._queues.get(group)
+        queue = users.get(user) if users else None
+        if queue is None or future not in queue:
+            return
+        queue.remove(future)
+        self._waiting[group] -= 1
+        if not queue:
+            del users[user]
+        if not users:
+            del self._queues[group]
+            del self._waiting[group]
+
+    @property
+    def waiting(self) -> int:
+        return sum(self._waiting.values())
+
+
+class HostLimiter:
+    """按主机限制并发下载数，单个慢源不会占满所有连接"""
+
+    def __init__(self, per_host: int):
+        self.per_host = per_host
+        self._semaphores: Dict[str, asyncio.Semaphore] = {}
+
+    def __call__(self, url: str) -> asyncio.Semaphore:
+        host = urlsplit(url).hostname or ""
+        semaphore = self._semaphores.get(host)
+        if semaphore is None:
+            semaphore = self._semaphores[host] = asyncio.Semaphore(self.per_host)
+        return semaphore
+
+
+class TTLMap:
+    """带过期时间和容量上限的映射
+
+    同一个映射内所有条目的有效期相同，因此插入顺序就是过期顺序：
+    插入、查找、删除均为O(1)，过期清理只需从队首弹出已过期的条目。
+    超过容量上限时淘汰最早插入的条目。过期和淘汰只计数，由调用方定期汇总输出日志。
+    """
+
+    def __init__(self, ttl: float, max_size: int):
+        self.ttl = ttl
+        self.max_size = max_size
+        self._data: "OrderedDict[object, Tuple[float, object]]" = OrderedDict()  # {键: (过期时间, 值)}
+        self.expired = 0   # 累计过期条目数
+        self.evicted = 0   # 累计因容量上限淘汰的条目数
+
+    def set(self, key, value=None, now: Optional[float] = None):
+        if now is None:
+            now = time.monotonic()
+        self._data.pop(key, None)
+        self._data[key] = (now + self.ttl, value)
+        if len(self._data) > self.max_size:
+            self._data.popitem(last=False)
+            self.evicted += 1
+
+    def get(self, key, default=None, now: Optional[float] = None):
+        entry = self._data.get(key)
+        if entry is None:
+            return default
+        if entry[0] <= (time.monotonic() if now is None else now):
+            del self._data[key]
+            self.expired += 1
+            return default
+        return entry[1]
+
+    def __contains__(self, key) -> bool:
+        sentinel = object()
+        return self.get(key, sentinel) is not sentinel
+
+    def pop(self, key, default=None):
+        entry = self._data.pop(key, None)
+        return default if entry is None else entry[1]
+
+    def purge(self, now: Optional[float] = None) -> int:
+        """从队首清理已过期的条目，返回清理数量"""
+        if now is None:
+            now = time.monotonic()
+        data = self._data
+        count = 0
+        while data:
+            key, (expire_at, _) = next(iter(data.items()))
+            if expire_at > now:
+                break
+            del data[key]
+            count += 1
+        self.expired += count
+        return count
+
+    def clear(self):
+        self._data.clear()
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+
+class RateLimiter:
+    """按键（用户或群）的令牌桶限流：每分钟补充 per_minute 个令牌，最多积累 burst 个
+
+    桶状态保存在 TTLMap 中，补满所需的时间过后条目自然过期（等同于满桶），不需要单独清理。
+    排队等待的请求会预先扣除令牌（余额可为负），之后到达的请求排在它们后面。
+    """
+
+    def __init__(self, per_minute: float, burst: int, max_wait: float = 0):
+        self.rate = per_minute / 60.0
+        self.burst = max(1, burst)
+        ttl = self.burst / self.rate + max_wait + 1 if self.rate > 0 else 1
+        self._buckets = TTLMap(ttl, max_size=100000)  # {键: (令牌数, 更新时间)}
+
+    @property
+    def enabled(self) -> bool:
+        return self.rate > 0
+
+    def _tokens(self, key: str, now: float) -> float:
+        state = self._buckets.get(key, now=now)
+        if state is None:
+            return float(self.burst)
+        tokens, updated = state
+        return min(float(self.burst), tokens + (now - updated) * self.rate)
+
+    def wait_time(self, key: str, now: float) -> float:
+        """距离有可用令牌还需等待的秒数，0表示可以立即通过"""
+        if not self.enabled:
+            return 0.0
+        tokens = self._tokens(key, now)
+        return 0.0 if tokens >= 1 else (1 - tokens) / self.rate
+
+    def take(self, key: str, now: float):
+        """扣除一个令牌（令牌不足时记为欠额，由调用方先等待 wait_time）"""
+        if self.enabled:
+            self._buckets.set(key, (self._tokens(key, now) - 1, now), now=now)
+
+    def purge(self) -> int:
+        return self._buckets.purge()
+
+
+class RequestCoalescer:
+    """请求合并：同一键在 window 秒内到达的请求合并为一批
+
+    第一个请求等待 window 秒收集同批请求，然后一次批量获取，为每个请求分配一个不同的结果；
+    每批最多 max_batch 个请求，超出后开始新的一批。
+    """
+
+    def __init__(self, window: float, max_batch: int,
+                 fetch_batch: Callable[[Tuple, int], Awaitable[List[Optional[str]]]]):
+        self.window = window
+        self.max_batch = max(1, max_batch)
+        self._fetch_batch = fetch_batch
+        self._open: Dict[Tuple, List[asyncio.Future]] = {}  # {键: 正在收集的请求}
+        self._running: Set[asyncio.Task] = set()  # 进行中的批次，保留引用以免任务被回收
+        self.batches = 0
+        self.coalesced = 0  # 并入他人批次的请求数
+
+    async def get(self, key: Tuple) -> Optional[str]:
+        if self.window <= 0:
+            results = await self._fetch_batch(key, 1)
+            return results[0] if results else None
+
+        future = asyncio.get_running_loop().create_future()
+        waiters = self._open.get(key)
+        if waiters is not None and len(waiters) < self.max_batch:
+            waiters.append(future)
+            self.coalesced += 1
+        else:
+            waiters = self._open[key] = [future]
+            task = asyncio.create_task(self._run(key, waiters))
+            self._running.add(task)
+            task.add_done_callback(self._running.discard)
+        return await future
+
+    async def _run(self, key: Tuple, waiters: List[asyncio.Future]):
+        results = []
+        try:
+            await asyncio.sleep(self.window)
+            if self._open.get(key) is waiters:
+                del self._open[key]
+            self.batches += 1
+            results = await self._fetch_batch(key, len(waiters))
+        except Exception as e:
+            logger.error(f"批量获取图片失败: {e}")
+        finally:
+            # 被取消时同样结束这一批，等待中的请求得到空结果
+            for i, future in enumerate(waiters):
+                if not future.done():
+                    future.set_result(results[i] if i < len(results) else None)
+
+    def clear(self):
+        """取消进行中的批次，仍在收集的请求直接得到空结果（任务在启动前被取消时不会执行 finally）"""
+        for task in self._running:
+            task.cancel()
+        for waiters in self._open.values():
+            for future in waiters:
+                if not future.done():
+                    future.set_result(None)
+        self._open.clear()
+
+
+class MemoryHistory:
+    """进程内的发送历史，记录 (范围, URL) 在去重窗口内是否已发送"""
+
+    def __init__(self, window: float, max_size: int = 1000000):
+        self.window = window
+        self._sent = TTLMap(window, max_size)
+
+    async def claim(self, scope: str, url: str, now: float) -> bool:
+        """窗口内未发送过时登记并返回True，否则返回False"""
+        key = (scope, url)
+        if key in self._sent:
+            return False
+        self._sent.set(key)
+        return True
+
+    async def mark(self, scope: str, url: str, now: float):
+        self._sent.set((scope, url))
+
+    async def purge(self) -> int:
+        return self._sent.purge()
+
+    async def close(self):
+        self._sent.clear()
+
+
+class SqliteHistory:
+    """基于SQLite（WAL模式）的发送历史
+
+    重启后仍然有效，同一台机器上的多个机器人进程可以共享同一个数据库文件。
+    URL以8字节哈希保存；登记通过单条UPSERT完成，多个进程同时抽到同一URL时只有一个能登记成功。
+    所有数据库操作在单独的线程中串行执行，不阻塞事件循环。
+    """
+
+    def __init__(self, path: str, window: float):
+        self.path = path
+        self.window = window
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="image-history")
+        self._conn: Optional[sqlite3.Connection] = None
+
+    def _connect(self) -> sqlite3.Connection:
+        if self._conn is None:
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS sent_history ("
+                "scope TEXT NOT NULL, url_hash INTEGER NOT NULL, sent_at REAL NOT NULL, "
+                "PRIMARY KEY (scope, url_hash)) WITHOUT ROWID"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS sent_history_sent_at ON sent_history (sent_at)")
+            self._conn = conn
+        return self._conn
+
+    @staticmethod
+    def _hash(url: str) -> int:
+        return int.from_bytes(hashlib.sha1(url.encode('utf-8')).digest()[:8], 'big', signed=True)
+
+    def _claim_sync(self, scope: str, url: str, now: float) -> bool:
+        cursor = self._connect().execute(
+            "INSERT INTO sent_history (scope, url_hash, sent_at) VALUES (?, ?, ?) "
+            "ON CONFLICT (scope, url_hash) DO UPDATE SET sent_at = excluded.sent_at "
+            "WHERE sent_history.sent_at <= ?",
+            (scope, self._hash(url), now, now - self.window),
+        )
+        return cursor.rowcount == 1
+
+    def _mark_sync(self, scope: str, url: str, now: float):
+        self._connect().execute(
+            "INSERT OR REPLACE INTO sent_history (scope, url_hash, sent_at) VALUES (?, ?, ?)",
+            (scope, self._hash(url), now),
+        )
+
+    def _purge_sync(self) -> int:
+        cursor = self._connect().execute(
+            "DELETE FROM sent_history WHERE sent_at <= ?", (time.time() - self.window,)
+        )
+        return cursor.rowcount
+
+    def _close_sync(self):
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+    async def _run(self, func: Callable, *args):
+        return await asyncio.get_running_loop().run_in_executor(self._executor, func, *args)
+
+    async def claim(self, scope: str, url: str, now: float) -> bool:
+        """窗口内未发送过时登记并返回True，否则返回False"""
+        return await self._run(self._claim_sync, scope, url, now)
+
+    async def mark(self, scope: str, url: str, now: float):
+        await self._run(self._mark_sync, scope, url, now)
+
+    async def purge(self) -> int:
+        return await self._run(self._purge_sync)
+
+    async def close(self):
+        await self._run(self._close_sync)
+        self._executor.shutdown(wait=False)
+
+
+class CircuitBreaker:
+    """熔断器：连续失败达到阈值后熔断一段时间，冷却结束后放行一次试探请求"""
+
+    def __init__(self, failure_threshold: int, cooldown: float):
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self.failures = 0
+        self._opened_at: Optional[float] = None
+        self._probe_at: Optional[float] = None
+
+    def is_open(self, now: Optional[float] = None) -> bool:
+        """是否处于熔断中（冷却未结束），不消耗试探名额"""
+        if self._opened_at is None:
+            return False
+        return (time.monotonic() if now is None else now) - self._opened_at < self.cooldown
+
+    def allow(self, now: Optional[float] = None) -> bool:
+        """是否放行本次请求；冷却结束后每个冷却周期只放行一次试探"""
+        if self._opened_at is None:
+            return True
+        if now is None:
+            now = time.monotonic()
+        if now - self._opened_at < self.cooldown:
+            return False
+        if self._probe_at is not None and now - self._probe_at < self.cooldown:
+            return False
+        self._probe_at = now
+        return True
+
+    def record_success(self):
+        self.failures = 0
+        self._opened_at = self._probe_at = None
+
+    def record_failure(self, now: Optional[float] = None):
+        self.failures += 1
+        if self._probe_at is not None or self.failures >= self.failure_threshold:
+            self._opened_at = time.monotonic() if now is None else now
+            self._probe_at = None
+
+    @property
+    def state(self) -> str:
+        if self._opened_at is None:
+            return "closed"
+        return "open" if self.is_open() else "half-open"
+
+
+class SourceHealth:
+    """图片来源健康状况
+
+    - URL负缓存：404等明确失效的链接长时间跳过，超时等临时失败短时间跳过；
+    - 按主机熔断：同一主机连续临时失败后暂停下载；
+    - 按来源（链接池/API）统计成功率和延迟的指数滑动平均，用于加权选择来源。
+    """
+
+    # 指数滑动平均的平滑系数
+    ALPHA = 0.2
+
+    def __init__(self, dead_ttl: float, retry_ttl: float, failure_threshold: int, cooldown: float):
+        self._dead = TTLMap(dead_ttl, max_size=100000)      # 明确失效的链接
+        self._failed = TTLMap(retry_ttl, max_size=100000)   # 临时失败的链接
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self._hosts: Dict[str, CircuitBreaker] = {}          # {主机: 熔断器}
+        self._sources: Dict[str, List[float]] = {}           # {来源: [成功率, 平均延迟ms]}
+
+    def host_breaker(self, url: str) -> CircuitBreaker:
+        host = urlsplit(url).hostname or ""
+        breaker = self._hosts.get(host)
+        if breaker is None:
+            breaker = self._hosts[host] = CircuitBreaker(self.failure_threshold, self.cooldown)
+        return breaker
+
+    def is_usable(self, url: str) -> bool:
+        """链接不在负缓存中且所在主机未熔断"""
+        return url not in self._dead and url not in self._failed and not self.host_breaker(url).is_open()
+
+    def record_success(self, url: str):
+        self._failed.pop(url)
+        self.host_breaker(url).record_success()
+
+    def record_failure(self, url: str, dead: bool):
+        """记录下载失败；dead 表示链接本身失效（如404），不计入主机熔断"""
+        if dead:
+            self._dead.set(url)
+        else:
+            self._failed.set(url)
+            self.host_breaker(url).record_failure()
+
+    def record_source(self, source: str, ok: bool, latency_ms: float):
+        stats = self._sources.get(source)
+        if stats is None:
+            self._sources[source] = [1.0 if ok else 0.0, latency_ms]
+            return
+        stats[0] += self.ALPHA * ((1.0 if ok else 0.0) - stats[0])
+        stats[1] += self.ALPHA * (latency_ms - stats[1])
+
+    def weight(self, source: str) -> float:
+        """来源的选择权重：近期成功率越高、延迟越低权重越大，没有记录的来源按健康处理"""
+        stats = self._sources.get(source)
+        if stats is None:
+            return 1.0
+        return max(0.05, stats[0]) / (1.0 + stats[1] / 1000.0)
+
+    def purge(self) -> int:
+        return self._dead.purge() + self._failed.purge()
+
+    def summary(self) -> str:
+        open_hosts = sum(1 for breaker in self._hosts.values() if breaker.is_open())
+        return f"失效链接 {len(self._dead)} 个, 临时失败 {len(self._failed)} 个, 熔断主机 {open_hosts} 个"
+
+
+def _is_dead_link_error(error: Exception) -> bool:
+    """是否为重试也不会成功的下载错误：链接失效、内容不是图片或超过大小上限"""
+    if isinstance(error, httpx.HTTPStatusError):
+        return error.response.status_code in (400, 401, 403, 404, 410, 451)
+    return isinstance(error, ValueError)
+
 
 @register("图片响应插件", "AI Assistant", "基于关键词触发的图片响应插件", "1.0.0")
 class ImageResponsePlugin(Star):
+    # 流式下载每次读取的块大小
+    DOWNLOAD_CHUNK_SIZE = 64 * 1024
+    # 后台维护任务的执行间隔（秒）
+    MAINTENANCE_INTERVAL = 60
+    # 抽到的候选URL已被其他范围或进程发送过、或暂不可用时，最多重新抽取的次数
+    MAX_CLAIM_ATTEMPTS = 8
+    # 超时等临时失败的链接在这段时间内（秒）不再抽取
+    DOWNLOAD_RETRY_DELAY = 600
+    
     def __init__(self, context: Context, config: AstrBotConfig):
         super().__init__(context)
         self.config = config
@@ -35,57 +1658,179 @@ class ImageResponsePlugin(Star):
         self.show_avatar = self.config.get("show_avatar", False)
         self.local_image_dir = self.config.get("local_image_dir", "")
         self.external_api = self.config.get("external_api", "https://api.lolicon.app/setu/v2?r18=1")
+        # 本地图片目录索引，首次使用时在线程中扫描
+        self.local_index = LocalImageIndex(self.local_image_dir, self.config.get("local_image_recursive", False))
         
-        # 图片缓存配置
-        self.cache_duration = self.config.get("cache_duration", 300)  # 默认5分钟缓存
-        self.image_cache = {}
+        # 预编译关键词路由表和匹配器，只在初始化和重载时构建；路由中的别名同样可以触发
+        self.router = KeywordRouter(self.config.get("keyword_routes", []), self.keywords)
+        self.keyword_matcher = KeywordMatcher(list(self.keywords) + self.router.keywords)
+        self._route_local_indexes: Dict[str, LocalImageIndex] = {}  # {路由指定的本地目录: 索引}
         
         # 初始化目录路径
         self.data_dir = os.path.dirname(os.path.abspath(__file__))
-        self.tu_dir = os.path.join(self.data_dir, "tu")
+        # 运行时生成的文件（临时文件、图片缓存、发送记录）可放到单独的目录，默认在插件目录下
+        self.work_dir = self.config.get("work_dir", "") or self.data_dir
+        self.tu_dir = self.config.get("tu_dir", "") or os.path.join(self.data_dir, "tu")
         self.font_dir = os.path.join(self.data_dir, "font")
         self.avatar_dir = os.path.join(self.data_dir, "avatars")
-        self.temp_dir = os.path.join(self.data_dir, "temp")  # 添加专用临时目录
+        self.temp_dir = os.path.join(self.work_dir, "temp")  # 添加专用临时目录
+        self.cache_dir = os.path.join(self.work_dir, "cache")  # 下载图片的持久缓存目录
         
         # 创建必要的目录
         os.makedirs(self.tu_dir, exist_ok=True)
         os.makedirs(self.font_dir, exist_ok=True)
         os.makedirs(self.avatar_dir, exist_ok=True)
         os.makedirs(self.temp_dir, exist_ok=True)  # 创建临时目录
+        os.makedirs(self.cache_dir, exist_ok=True)
         
         # 设置临时文件的目录
         tempfile.tempdir = self.temp_dir
         
-        # 并发控制
-        self.semaphore = asyncio.Semaphore(5)
+        # 正在发送的图片，缓存淘汰时跳过
+        self.pins = PathPins()
+        # 临时目录清理：由后台维护任务定期删除过期的遗留文件，保留 README 使用的效果图
+        self.temp_janitor = TempJanitor(self.temp_dir, self.config.get("temp_max_age", 86400), keep=("1.png",))
+        
+        # 磁盘图片缓存：按URL哈希保存下载过的图片，重启后仍然有效
+        self.disk_cache = ImageCache(
+            self.cache_dir,
+            max_bytes=self.config.get("image_cache_max_mb", 512) * 1024 * 1024,
+            ttl=self.config.get("image_cache_ttl", 604800),
+            pins=self.pins,
+        )
+        self._pending_downloads: Dict[str, asyncio.Task] = {}  # {URL: 下载任务}
+        self.max_image_bytes = self.config.get("max_image_mb", 20) * 1024 * 1024
+        
+        # 并发控制：回复按群/用户公平排队，磁盘、API和各下载主机分别限流
+        self.scheduler = FairScheduler(
+            self.config.get("max_concurrent_replies", 5),
+            max_waiting_per_group=self.config.get("max_waiting_per_group", 5),
+            max_waiting_per_user=self.config.get("max_waiting_per_user", 2),
+        )
+        self.reply_queue_timeout = self.config.get("reply_queue_timeout", 10)
+        # 限流：按用户和群的令牌桶，超出后按策略丢弃、排队或提示
+        self._load_rate_limit_config()
+        # 请求合并（默认关闭）：同一群短时间内的相同请求合并为一批，共用一次来源选择，各自得到不同的图片
+        self.coalescer = RequestCoalescer(
+            self.config.get("coalesce_window", 0),
+            self.config.get("coalesce_max_batch", 5),
+            self._fetch_image_batch,
+        )
+        # 来源对冲：当前来源超过该时间没有结果就并行尝试下一个来源；整次获取图片的时间上限
+        self.source_hedge_delay = self.config.get("source_hedge_delay", 3)
+        self.reply_deadline = self.config.get("reply_deadline", 45)
+        self.disk_semaphore = asyncio.Semaphore(self.config.get("disk_concurrency", 2))
+        self.api_semaphore = asyncio.Semaphore(self.config.get("api_concurrency", 2))
+        self.host_limiter = HostLimiter(self.config.get("per_host_downloads", 4))
+        
+        # 图片处理：水印和压缩可选在进程池中执行，结果按源图片和参数缓存
+        self.image_workers = ImageWorkerPool(self.config.get("watermark_processes", 0))
+        self._watermark_font_path = self._resolve_watermark_font()
+        self._watermark_tag = self._compute_watermark_tag()
+        self._load_transform_config()
+        self._pending_derived: Dict[str, asyncio.Task] = {}  # {派生图片键: 渲染任务}
+        self._transform_skipped = TTLMap(24 * 3600, max_size=10000)  # 压缩后没有变小、直接使用原图的派生键
+        
+        # 后台定期维护任务（过期记录清理等），首次收到消息时启动
+        self._maintenance_task: Optional[asyncio.Task] = None
         
         # HTTP客户端
-        self._http_timeout = httpx.Timeout(30.0)
-        self._connection_limit = httpx.AsyncHTTPTransport(limits=httpx.Limits(max_connections=10))
+        self._http_timeout = httpx.Timeout(self.config.get("http_timeout", 30))
+        self._http_client: Optional[httpx.AsyncClient] = None  # 插件生命周期内共享，卸载时关闭
         
-        # 清理旧的临时文件
-        self._clean_old_temp_files()
+        # TXT图片链接索引：首次使用时在线程中加载，之后按文件变化增量刷新
+        self.url_pools = UrlPoolIndex(self.tu_dir)
+        self._watch_selected_txt_files()
         
-        # 图片去重机制 - 记录1小时内发送过的图片
-        self.sent_images = {}  # {image_url: timestamp}
+        # 图片去重机制 - 每个链接池一个采样器，1小时内不重复抽取同一链接
         self.sent_images_timeout = 3600  # 1小时超时（秒）
+        self._samplers: Dict[str, NonRepeatingSampler] = {}  # {链接池索引键: 采样器}
+        
+        # 来源健康状况：失效链接负缓存、按主机和外部API熔断、按成功率和延迟加权选择来源
+        self.health = SourceHealth(
+            dead_ttl=self.config.get("dead_link_ttl", 21600),
+            retry_ttl=self.DOWNLOAD_RETRY_DELAY,
+            failure_threshold=self.config.get("source_failure_threshold", 5),
+            cooldown=self.config.get("source_cooldown", 60),
+        )
+        self.api_breaker = CircuitBreaker(self.health.failure_threshold, self.health.cooldown)
+        # 外部API结果缓冲：一次请求多条图片记录（lolicon API 的 num 参数），用完前在后台补充
+        self.api_buffer = ApiBatchBuffer(self.config.get("api_batch_size", 10), self._request_api_batch)
+        
+        # 发送历史：按范围（全局/群/用户）记录，可持久化到SQLite供重启后和多个实例共享
+        self.dedup_scope = self.config.get("dedup_scope", "global")
+        self.history = self._create_history_backend()
+        
+        # 预取队列：每个来源预先下载若干张图片，回复时直接使用
+        self.prefetcher = PrefetchQueue(self.config.get("prefetch_depth", 2), self._prefetch_source)
+        # 运行指标：各阶段耗时和计数，可定期导出为 Prometheus 文本文件
+        self.metrics = PipelineMetrics()
+        self.metrics_file = self.config.get("metrics_file", "")
+        self.slow_reply_ms = self.config.get("slow_reply_ms", 5000)
+        
+    def _watch_selected_txt_files(self):
+        """让链接索引跟踪配置和关键词路由中以绝对路径指定的TXT文件"""
+        for selected_file in list(self.selected_txt_files) + list(self.router.targets("txt")):
+            if os.path.isabs(selected_file):
+                self.url_pools.watch(selected_file)
+    
+    async def _get_http_client(self) -> httpx.AsyncClient:
+        """获取共享的HTTP客户端，复用连接池和keep-alive连接"""
+        if self._http_client is None or self._http_client.is_closed:
+            self._http_client = self._create_http_client()
+        return self._http_client
+    
+    def _create_http_client(self) -> httpx.AsyncClient:
+        """按配置创建带连接池限制的HTTP客户端，可选启用HTTP/2"""
+        http2 = self.config.get("http2", False)
+        if http2:
+            try:
+                import h2  # noqa: F401
+            except ImportError:
+                logger.warning("未安装h2，已禁用HTTP/2。如需启用请安装 httpx[http2]")
+                http2 = False
         
-    async def _get_http_client(self):
-        return httpx.AsyncClient(timeout=self._http_timeout, transport=self._connection_limit)
+        limits = httpx.Limits(
+            max_connections=self.config.get("http_max_connections", 20),
+            max_keepalive_connections=self.config.get("http_max_keepalive_connections", 10),
+            keepalive_expiry=self.config.get("http_keepalive_expiry", 60),
+        )
+        return httpx.AsyncClient(timeout=self._http_timeout, limits=limits, http2=http2)
+    
+    async def terminate(self):
+        """插件卸载时停止后台任务、关闭图片处理进程池和共享的HTTP客户端"""
+        if self._maintenance_task is not None:
+            self._maintenance_task.cancel()
+        self.prefetcher.clear()
+        self.api_buffer.clear()
+        self.coalescer.clear()
+        self.local_index.cancel()
+        for index in self._route_local_indexes.values():
+            index.cancel()
+        self.image_workers.shutdown()
+        if self.history is not None:
+            await self.history.close()
+        if self._http_client is not None:
+            await self._http_client.aclose()
+            self._http_client = None
     
     # 关键词消息处理器
     @filter.event_message_type(filter.EventMessageType.ALL)
     async def keyword_handler(self, event: AstrMessageEvent):
         """处理包含关键词的消息"""
+        self._ensure_background_tasks()
+        started = time.perf_counter()
         message_str = event.message_str.strip().lower()
         
-        # 检查消息是否包含任何关键词
-        for keyword in self.keywords:
-            if keyword.lower() in message_str:
-                logger.info(f"检测到关键词: {keyword}")
-                async for result in self.handle_image_response(event, keyword):
-                    yield result
-                break
+        # 一次扫描找出优先级最高的关键词
+        keyword = self.keyword_matcher.match(message_str)
+        self.metrics.observe("keyword_match", (time.perf_counter() - started) * 1000)
+        if keyword is None:
+            return
+        
+        logger.debug(f"检测到关键词: {keyword}")
+        async for result in self.handle_image_response(event, keyword):
+            yield result
     
     # 命令处理器 - 用于管理插件
     @filter.command("image_help")
@@ -104,9 +1849,15 @@ class ImageResponsePlugin(Star):
         - @用户功能: {'开启' if self.at_user else '关闭'}
         - 水印功能: {'开启' if self.watermark_text else '关闭'}
         - 显示头像: {'开启' if self.show_avatar else '关闭'}
+        - 图片缓存: 上限 {self.disk_cache.max_bytes // 1048576} MB, 有效期 {f'{self.disk_cache.ttl / 3600:g} 小时' if self.disk_cache.ttl else '不过期'}
+        
+        **可用命令:**
+        - /image_help: 查看本帮助信息
+        - /image_reload: 重新加载配置和关键词列表
+        - /image_stats: 查看回复延迟和预取统计
         
         **注意事项:**
-        - 插件有5分钟图片缓存机制
+        - 下载过的图片保存在磁盘缓存中，重复图片无需再次下载，超过上限时淘汰最久未使用的图片
         - 可通过后台管理界面修改所有配置
         """
         yield event.plain_result(help_text)
@@ -116,8 +1867,13 @@ class ImageResponsePlugin(Star):
     async def reload_command(self, event: AstrMessageEvent):
         """重新加载配置"""
         try:
+            # 先构建新的关键词路由表和匹配器，失败时保持原有配置不变
+            keywords = self.config.get("keywords", self.default_keywords)
+            router = KeywordRouter(self.config.get("keyword_routes", []), keywords)
+            keyword_matcher = KeywordMatcher(list(keywords) + router.keywords)
+            
             # 重新读取配置
-            self.keywords = self.config.get("keywords", self.default_keywords)
+            self.keywords = keywords
             self.custom_text = self.config.get("custom_text", self.default_text)
             self.at_user = self.config.get("at_user", True)
             self.selected_txt_files = self.config.get("selected_txt_files", [])
@@ -126,35 +1882,121 @@ class ImageResponsePlugin(Star):
             self.show_avatar = self.config.get("show_avatar", False)
             self.local_image_dir = self.config.get("local_image_dir", "")
             self.external_api = self.config.get("external_api", "https://api.lolicon.app/setu/v2?r18=0")
+            self.source_hedge_delay = self.config.get("source_hedge_delay", 3)
+            self.reply_deadline = self.config.get("reply_deadline", 45)
+            self.metrics_file = self.config.get("metrics_file", "")
+            self.slow_reply_ms = self.config.get("slow_reply_ms", 5000)
+            self._load_rate_limit_config()
+            self.coalescer.window = self.config.get("coalesce_window", 0)
+            self.coalescer.max_batch = max(1, self.config.get("coalesce_max_batch", 5))
+            local_recursive = self.config.get("local_image_recursive", False)
+            if (self.local_image_dir, local_recursive) != (self.local_index.root, self.local_index.recursive):
+                self.local_index.cancel()
+                self.local_index = LocalImageIndex(self.local_image_dir, local_recursive)
+            self._watermark_font_path = self._resolve_watermark_font()
+            
+            # 水印或压缩参数变化时清理旧的派生图片
+            self._watermark_tag = self._compute_watermark_tag()
+            await self.disk_cache.invalidate("wm", keep_tag=self._watermark_tag)
+            self._load_transform_config()
+            self._transform_skipped.clear()
+            await self.disk_cache.invalidate("tf", keep_tag=self._transform_tag)
+            
+            # 整体替换关键词路由表和匹配器，处理中的请求不受影响
+            self.keyword_matcher, self.router = keyword_matcher, router
+            for index in self._route_local_indexes.values():
+                index.cancel()
+            self._route_local_indexes = {}
+            
+            # 重新扫描图片链接文件
+            self._watch_selected_txt_files()
+            await asyncio.to_thread(self.url_pools.refresh_sync)
             
             # 清空缓存
-            self.image_cache.clear()
+            self.prefetcher.clear()
+            self.api_buffer.clear()
             
             yield event.plain_result(f"配置已重新加载！\n当前关键词: {', '.join(self.keywords)}")
         except Exception as e:
             logger.error(f"重新加载配置失败: {e}")
             yield event.plain_result(f"重新加载配置失败: {str(e)}")
     
+    # 命令处理器 - 查看运行统计
+    @filter.command("image_stats")
+    async def stats_command(self, event: AstrMessageEvent):
+        """显示各阶段耗时、计数和预取统计"""
+        prefetcher = self.prefetcher
+        metrics = self.metrics
+        stats_text = "\n".join(metrics.stage_summary() + [
+            f"回复 {metrics.count('replies')} 次, 无图 {metrics.count('empty_replies')} 次, "
+            f"下载缓存命中 {metrics.count('cache_hits')} 次, 淘汰 {self.disk_cache.evictions} 个文件, "
+            f"下载 {metrics.count('downloads')} 次, "
+            f"去重回退 {metrics.count('dedup_fallbacks')} 次, 来源失败 {metrics.count('source_failures')} 次, "
+            f"限流 {metrics.count('rate_limited')} 次, 合并请求 {self.coalescer.coalesced} 次\n"
+            f"预取: 深度 {prefetcher.depth}, 就绪 {prefetcher.ready_count()} 张, "
+            f"命中 {prefetcher.hits} 次, 未命中 {prefetcher.misses} 次\n"
+            f"API缓冲: {len(self.api_buffer)} 条, 已请求API {self.api_buffer.requests} 次\n"
+            f"来源健康: {self.health.summary()}, 外部API {self.api_breaker.state}"
+        ])
+        yield event.plain_result(stats_text)
+    
     async def handle_image_response(self, event: AstrMessageEvent, keyword: str):
         """处理图片响应的核心逻辑"""
         user_id = event.get_sender_id()
+        started = time.perf_counter()
+        
+        group_id = event.get_group_id() or f"private:{user_id}"
+        if not await self._check_rate_limit(group_id, user_id):
+            self.metrics.incr("rate_limited")
+            if self.rate_limit_policy == "reply":
+                yield event.plain_result("请求太频繁了，请稍后再试。")
+            return
+        
+        # 按群/用户排队获取处理名额，等待过久直接回复繁忙
+        if not await self.scheduler.acquire(group_id, user_id, self.reply_queue_timeout):
+            logger.warning(f"请求排队已满或等待超时: 群 {group_id} 用户 {user_id}")
+            yield event.plain_result("当前请求较多，请稍后再试。")
+            return
         
+        trace: Dict[str, float] = {}  # {阶段: 耗时ms}，用于慢回复日志
+        pinned: List[str] = []  # 本次回复用到的文件，发送完成前不会被清理
         try:
-            logger.info(f"为用户 {user_id} 处理关键词 '{keyword}' 的图片响应")
-            # 尝试获取图片
-            image_path = await self.get_image(keyword)
+            try:
+                logger.debug(f"为用户 {user_id} 处理关键词 '{keyword}' 的图片响应")
+                # 尝试获取图片
+                stage_started = time.perf_counter()
+                image_path = await self.coalescer.get((group_id, keyword, self._dedup_scope_key(event)))
+                trace["source"] = (time.perf_counter() - stage_started) * 1000
+                if image_path:
+                    logger.debug(f"成功获取图片: {image_path}")
+                    self._pin(image_path, pinned)
+                    
+                    # 缩小和重新编码（如果配置），在加水印之前进行以减少渲染量
+                    if self._transform_tag:
+                        stage_started = time.perf_counter()
+                        image_path = await self.transform_image(image_path)
+                        self._pin(image_path, pinned)
+                        trace["transform"] = (time.perf_counter() - stage_started) * 1000
+                    
+                    # 添加水印（如果配置）
+                    if self.watermark_text:
+                        stage_started = time.perf_counter()
+                        try:
+                            image_path = await self.add_watermark(image_path)
+                            self._pin(image_path, pinned)
+                        except Exception as e:
+                            logger.error(f"添加水印失败: {e}")
+                        trace["watermark"] = (time.perf_counter() - stage_started) * 1000
+            finally:
+                self.scheduler.release()
+                for stage, ms in trace.items():
+                    self.metrics.observe(stage, ms)
+            
             if not image_path:
+                self.metrics.incr("empty_replies")
                 logger.warning(f"未能为关键词 '{keyword}' 获取图片")
                 yield event.plain_result("抱歉，未能找到合适的图片。")
                 return
-            logger.info(f"成功获取图片: {image_path}")
-            
-            # 添加水印（如果配置）
-            if self.watermark_text:
-                try:
-                    image_path = await self.add_watermark(image_path)
-                except Exception as e:
-                    logger.error(f"添加水印失败: {e}")
             
             # 准备回复消息链
             chain = []
@@ -170,174 +2012,412 @@ class ImageResponsePlugin(Star):
             # 添加图片
             chain.append(Image(file=image_path))
             
-            # 发送消息
+            # 发送消息（框架处理完这条结果后才会继续执行生成器，期间计为发送耗时）
+            reply_ms = (time.perf_counter() - started) * 1000
+            self.metrics.observe("reply", reply_ms)
+            self.metrics.incr("replies")
+            stage_started = time.perf_counter()
             yield event.chain_result(chain)
+            trace["send"] = (time.perf_counter() - stage_started) * 1000
+            self.metrics.observe("send", trace["send"])
+            
+            # 只为慢回复输出各阶段耗时，避免逐条日志的开销
+            if reply_ms >= self.slow_reply_ms:
+                stages = ", ".join(f"{stage} {ms:.0f}ms" for stage, ms in trace.items())
+                logger.info(f"慢回复 {reply_ms:.0f}ms (关键词 '{keyword}'): {stages}")
             
         except Exception as e:
             logger.error(f"处理图片响应时出错: {e}")
             yield event.plain_result(f"处理图片时发生错误: {str(e)}")
+        finally:
+            for path in pinned:
+                self.pins.unpin(path)
+    
+    def _load_rate_limit_config(self):
+        """读取限流配置，每分钟次数为0时不限制"""
+        self.rate_limit_policy = self.config.get("rate_limit_policy", "reply")
+        self.user_limiter = RateLimiter(
+            self.config.get("user_rate_per_minute", 0),
+            self.config.get("user_rate_burst", 3),
+            max_wait=self.reply_queue_timeout,
+        )
+        self.group_limiter = RateLimiter(
+            self.config.get("group_rate_per_minute", 0),
+            self.config.get("group_rate_burst", 5),
+            max_wait=self.reply_queue_timeout,
+        )
+    
+    async def _check_rate_limit(self, group_id: str, user_id: str) -> bool:
+        """检查用户和群的令牌桶；queue 策略下等待不超过 reply_queue_timeout 秒后放行"""
+        now = time.monotonic()
+        wait = max(self.user_limiter.wait_time(user_id, now), self.group_limiter.wait_time(group_id, now))
+        if wait > 0 and (self.rate_limit_policy != "queue" or wait > self.reply_queue_timeout):
+            return False
+        self.user_limiter.take(user_id, now)
+        self.group_limiter.take(group_id, now)
+        if wait > 0:
+            await asyncio.sleep(wait)
+        return True
     
-    async def get_image(self, keyword: str) -> Optional[str]:
-        """获取图片的主要逻辑 - 确保每次都完全重新选择图片"""
-        logger.info(f"开始为关键词 '{keyword}' 获取新图片")
+    async def _fetch_image_batch(self, key: Tuple[str, str, str], count: int) -> List[Optional[str]]:
+        """为合并后的一批请求获取 count 张不同的图片（采样器和去重记录保证不重复）
+        
+        整批只选择一次来源：第一张按优先级和对冲规则获取，其余直接从成功的来源并行获取；
+        所有来源都失败时整批直接返回，不再为每个请求重复尝试失败的来源。
+        """
+        _, keyword, scope = key
+        loop = asyncio.get_running_loop()
+        # 整批共用一个截止时间，后续请求只能使用剩余的时间
+        deadline = loop.time() + self.reply_deadline
+        sources = await self._image_sources(keyword, scope)
+        first = await self._first_image(sources, deadline)
+        if first is None:
+            return []
+        index, image_path = first
+        name, fetch = sources[index]
+        
+        async def follow() -> Optional[str]:
+            result = await asyncio.wait_for(fetch(), max(0, deadline - loop.time()))
+            if result:
+                self.metrics.incr("source_hits", name)
+                return result
+            # 成功的来源暂时取不到新图片（如链接池已抽完），单独走完整的来源选择
+            result = await self._first_image(await self._image_sources(keyword, scope), deadline)
+            return result[1] if result else None
+        
+        results = await asyncio.gather(*(follow() for _ in range(count - 1)), return_exceptions=True)
+        return [image_path] + [None if isinstance(result, BaseException) else result for result in results]
+    
+    def _pin(self, path: str, pinned: List[str]):
+        """登记正在使用的文件，同一路径只登记一次"""
+        if path not in pinned:
+            self.pins.pin(path)
+            pinned.append(path)
+    
+    async def get_image(self, keyword: str, scope: str = "") -> Optional[str]:
+        """获取图片的主要逻辑 - 确保每次都完全重新选择图片
+        
+        按优先级依次尝试各来源；当前来源在 source_hedge_delay 秒内没有结果时，
+        并行启动下一个来源，取最先成功的图片，整体不超过 reply_deadline 秒。
+        """
+        logger.debug(f"开始为关键词 '{keyword}' 获取新图片")
         # 完全跳过缓存检查，确保每次都获取新的随机图片
         # 但仍保留1小时内图片URL去重功能
-        async with self.semaphore:
-            # 1. 尝试根据关键词匹配特定的TXT文件
-            image_path = await self._get_image_from_specific_txt(keyword)
-            if image_path:
-                await self._add_to_cache(keyword, image_path)
-                return image_path
-            
-            # 2. 尝试从配置的TXT文件中获取
-            image_path = await self._get_image_from_configured_txt()
-            if image_path:
-                await self._add_to_cache(keyword, image_path)
-                return image_path
-            
-            # 3. 尝试从本地图片目录获取
-            if self.local_image_dir and os.path.exists(self.local_image_dir):
-                image_path = await self._get_image_from_local_dir()
-                if image_path:
-                    await self._add_to_cache(keyword, image_path)
-                    return image_path
-            
-            # 4. 尝试从外部API获取
-            image_path = await self._get_image_from_api()
-            if image_path:
-                await self._add_to_cache(keyword, image_path)
-                return image_path
-            
+        result = await self._first_image(await self._image_sources(keyword, scope))
+        return result[1] if result else None
+    
+    async def _image_sources(self, keyword: str, scope: str) -> List[Tuple[str, Callable[[], Awaitable[Optional[str]]]]]:
+        """关键词可用的图片来源 (名称, 获取函数)，按尝试顺序排列"""
+        route = self.router.lookup(keyword)
+        if route is not None:
+            # 关键词有路由规则时只使用规则中的来源，按权重随机决定尝试顺序
+            return [
+                (f"route_{kind}", self._route_source(kind, target, scope))
+                for kind, target in KeywordRouter.order(route)
+            ]
+        
+        sources = []
+        # 1. 尝试根据关键词匹配特定的TXT文件；没有同名文件时跳过，不计为来源失败
+        try:
+            await self.url_pools.refresh()
+        except Exception as e:
+            logger.error(f"刷新图片链接文件失败: {e}")
+        if self.url_pools.find(keyword) is not None:
+            sources.append(("keyword_txt", lambda: self._get_image_from_specific_txt(keyword, scope)))
+        # 2. 尝试从配置的TXT文件中获取
+        sources.append(("configured_txt", lambda: self._get_image_from_configured_txt(scope)))
+        # 3. 尝试从本地图片目录获取
+        if self.local_image_dir and os.path.exists(self.local_image_dir):
+            sources.append(("local", self._get_image_from_local_dir))
+        # 4. 尝试从外部API获取
+        if self.external_api:
+            sources.append(("api", self._get_image_from_api))
+        return sources
+    
+    async def _first_image(self, sources: List[Tuple[str, Callable[[], Awaitable[Optional[str]]]]],
+                           deadline: Optional[float] = None) -> Optional[Tuple[int, str]]:
+        """按顺序启动各来源 (名称, 获取函数)，返回最先成功的 (来源序号, 图片路径)，并取消其余仍在进行的来源
+        
+        deadline 为事件循环时间的截止时刻，默认从现在起 reply_deadline 秒。
+        """
+        loop = asyncio.get_running_loop()
+        if deadline is None:
+            deadline = loop.time() + self.reply_deadline
+        pending: Set[asyncio.Task] = set()
+        indexes: Dict[asyncio.Task, int] = {}
+        next_index = 0
+        
+        def launch_next():
+            nonlocal next_index
+            if next_index < len(sources):
+                task = asyncio.create_task(sources[next_index][1]())
+                indexes[task] = next_index
+                pending.add(task)
+                next_index += 1
+        
+        launch_next()
+        try:
+            while pending:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    logger.warning(f"获取图片超过 {self.reply_deadline} 秒，放弃")
+                    self.metrics.incr("source_timeouts")
+                    return None
+                hedging = self.source_hedge_delay > 0 and next_index < len(sources)
+                if hedging:
+                    timeout = min(timeout, self.source_hedge_delay)
+                
+                done, _ = await asyncio.wait(pending, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+                if not done:
+                    # 当前来源迟迟没有结果，并行启动下一个来源
+                    if hedging:
+                        launch_next()
+                    continue
+                
+                pending -= done
+                for task in done:
+                    name = sources[indexes[task]][0]
+                    if not task.cancelled() and task.exception() is None and task.result():
+                        self.metrics.incr("source_hits", name)
+                        return indexes[task], task.result()
+                    self.metrics.incr("source_failures", name)
+                # 来源失败，立即尝试下一个
+                launch_next()
+            return None
+        finally:
+            for task in pending:
+                task.cancel()
+            if pending:
+                await asyncio.gather(*pending, return_exceptions=True)
+    
+    def _route_source(self, kind: str, target: str, scope: str) -> Callable[[], Awaitable[Optional[str]]]:
+        """路由规则中一个来源的获取函数"""
+        if kind == "api":
+            return self._get_image_from_api
+        if kind == "local":
+            return lambda: self._get_image_from_local_dir(self._get_local_index(target))
+        return lambda: self._get_image_from_txt_target(target, scope)
+    
+    async def _get_image_from_txt_target(self, target: str, scope: str = "") -> Optional[str]:
+        """从路由规则指定的TXT文件（文件名或绝对路径）中获取图片"""
+        await self.url_pools.refresh()
+        pool_key = target if target in self.url_pools.pools else self.url_pools.find(target)
+        if pool_key is None:
+            logger.warning(f"关键词路由指定的TXT文件不存在: {target}")
             return None
+        return await self._get_random_image_from_pool(pool_key, scope)
+    
+    def _get_local_index(self, root: str) -> LocalImageIndex:
+        """路由规则指定的本地目录索引，未指定目录时使用配置的本地图片目录"""
+        if not root or root == self.local_index.root:
+            return self.local_index
+        index = self._route_local_indexes.get(root)
+        if index is None:
+            index = LocalImageIndex(root, self.local_index.recursive)
+            self._route_local_indexes[root] = index
+        return index
     
-    async def _get_image_from_specific_txt(self, keyword: str) -> Optional[str]:
+    async def _get_image_from_specific_txt(self, keyword: str, scope: str = "") -> Optional[str]:
         """从与关键词匹配的TXT文件中获取图片"""
         try:
-            # 检查tu目录是否存在
-            if not os.path.exists(self.tu_dir):
-                logger.warning(f"目录不存在: {self.tu_dir}")
-                return None
-                
-            txt_files = [f for f in os.listdir(self.tu_dir) if f.endswith('.txt')]
+            await self.url_pools.refresh()
             
             # 寻找与关键词匹配的文件名（不包含.txt后缀）
-            for txt_file in txt_files:
-                file_name = os.path.splitext(txt_file)[0]
-                if keyword.lower() == file_name.lower():
-                    file_path = os.path.join(self.tu_dir, txt_file)
-                    logger.info(f"找到匹配的TXT文件: {file_path}")
-                    return await self._get_random_image_from_file(file_path)
+            pool_key = self.url_pools.find(keyword)
+            if pool_key is not None:
+                logger.debug(f"找到匹配的TXT文件: {pool_key}")
+                return await self._get_random_image_from_pool(pool_key, scope)
             
-            logger.info(f"未找到与关键词 '{keyword}' 匹配的TXT文件")
+            logger.debug(f"未找到与关键词 '{keyword}' 匹配的TXT文件")
         except Exception as e:
             logger.error(f"从特定TXT文件获取图片失败: {e}")
         return None
     
-    async def _get_image_from_configured_txt(self) -> Optional[str]:
+    async def _get_image_from_configured_txt(self, scope: str = "") -> Optional[str]:
         """从配置的TXT文件中获取图片"""
         try:
-            # 检查tu目录是否存在
-            if not os.path.exists(self.tu_dir):
-                logger.warning(f"目录不存在: {self.tu_dir}")
-                return None
-                
-            all_txt_files = [f for f in os.listdir(self.tu_dir) if f.endswith('.txt')]
+            await self.url_pools.refresh()
             
             # 确定要使用的TXT文件列表
-            txt_files_to_use = []
+            pools_to_use = []
             if self.selected_txt_files:
                 # 使用配置的特定文件，支持绝对路径
                 for selected_file in self.selected_txt_files:
                     # 检查是否为绝对路径
                     if os.path.isabs(selected_file):
-                        if os.path.exists(selected_file):
-                            txt_files_to_use.append(selected_file)
-                            logger.info(f"添加绝对路径文件: {selected_file}")
+                        if selected_file in self.url_pools.pools:
+                            pools_to_use.append(selected_file)
                         else:
                             logger.warning(f"配置的绝对路径文件不存在: {selected_file}")
                     else:
                         # 相对路径，在tu目录中查找
-                        full_name = f"{selected_file}.txt" if not selected_file.endswith('.txt') else selected_file
-                        if full_name in all_txt_files:
-                            txt_files_to_use.append(os.path.join(self.tu_dir, full_name))
+                        pool_key = self.url_pools.find(selected_file)
+                        if pool_key is not None:
+                            pools_to_use.append(pool_key)
             else:
                 # 使用所有文件
-                txt_files_to_use = [os.path.join(self.tu_dir, f) for f in all_txt_files]
+                pools_to_use = self.url_pools.keys()
             
-            if not txt_files_to_use:
-                logger.info("没有可用的TXT文件")
+            if not pools_to_use:
+                logger.debug("没有可用的TXT文件")
                 return None
             
-            # 随机选择一个文件
-            selected_file = random.choice(txt_files_to_use)
-            logger.info(f"随机选择的TXT文件: {selected_file}")
+            # 按近期成功率和延迟加权随机选择一个文件
+            weights = [self.health.weight(f"txt:{key}") for key in pools_to_use]
+            pool_key = random.choices(pools_to_use, weights=weights)[0]
+            logger.debug(f"随机选择的TXT文件: {pool_key}")
             
-            return await self._get_random_image_from_file(selected_file)
+            return await self._get_random_image_from_pool(pool_key, scope)
         except Exception as e:
             logger.error(f"从配置的TXT文件获取图片失败: {e}")
         return None
     
-    async def _get_random_image_from_file(self, file_path: str) -> Optional[str]:
-        """从指定的TXT文件中随机选择一个图片URL并下载，实现1小时内去重"""
+    async def _get_random_image_from_pool(self, pool_key: str, scope: str = "") -> Optional[str]:
+        """从指定的链接池中随机选择一个图片URL并下载，实现1小时内去重"""
         try:
-            logger.info(f"正在从文件 {file_path} 随机选择图片")
+            logger.debug(f"正在从链接池 {pool_key} 随机选择图片")
             
-            # 每次都重新读取文件，确保获取最新的URL列表
-            async with aiofiles.open(file_path, 'r', encoding='utf-8') as f:
-                lines = [line.strip() for line in await f.readlines() if line.strip()]
+            # 使用内存中的链接索引，文件变化时由索引增量刷新
+            lines = self.url_pools.get(pool_key)
             
             if not lines:
                 logger.warning("文件中没有有效图片URL")
                 return None
             
-            logger.info(f"找到 {len(lines)} 个图片URL")
-            
-            # 清理过期的已发送图片记录
-            current_time = time.time()
-            self._clean_expired_sent_images(current_time)
-            
-            # 创建未发送图片列表（1小时内未发送过的图片）
-            available_urls = [url for url in lines if url not in self.sent_images]
-            
-            # 如果所有图片都在1小时内发送过，则允许重复
-            if not available_urls:
-                logger.warning(f"所有 {len(lines)} 个图片URL在1小时内都已发送过，将允许重复发送")
-                available_urls = lines.copy()
-            else:
-                logger.info(f"有 {len(available_urls)} 个URL在1小时内未发送过")
-            
-            # 确保真正随机选择一个可用的URL
-            random.shuffle(available_urls)  # 先打乱顺序
-            image_url = random.choice(available_urls)
-            logger.info(f"随机选择的图片URL: {image_url}")
-            
-            # 下载图片
-            image_path = await self._download_image(image_url)
-            if image_path:
-                # 记录已发送图片（使用URL作为标识）
-                self.sent_images[image_url] = current_time
-                logger.info(f"记录已发送图片: {image_url}")
+            # 优先使用预取好的图片，取用时再按发送范围确认去重
+            while True:
+                item = self.prefetcher.take(f"txt:{pool_key}")
+                if item is None:
+                    break
+                image_url, image_path = item
+                if await self._claim_sent(scope, image_url):
+                    logger.debug(f"使用预取的图片: {image_path}")
+                    return image_path
             
-            return image_path
+            result = await self._fetch_from_pool(pool_key, lines, scope)
+            return result[1] if result else None
         except Exception as e:
-            logger.error(f"从文件获取随机图片失败: {e}")
+            logger.error(f"从链接池获取随机图片失败: {e}")
         return None
     
-    async def _get_image_from_local_dir(self) -> Optional[str]:
-        """从本地图片目录获取图片"""
+    async def _fetch_from_pool(self, pool_key: str, lines: Tuple[str, ...],
+                               scope: Optional[str]) -> Optional[Tuple[str, str]]:
+        """从链接池抽取一个1小时内未发送过的URL并下载，返回 (URL, 图片路径)
+        
+        scope 为None时只经过本进程的采样器，不登记发送历史（用于预取）。
+        按群/用户去重时采样器由所有范围共用，不能代替各范围的发送历史：
+        此时不放回地随机抽取候选，是否重复完全由发送历史判断。
+        """
+        if scope is not None and self.dedup_scope != "global":
+            candidates = [(url, False) for url in random.sample(lines, min(len(lines), self.MAX_CLAIM_ATTEMPTS))]
+        else:
+            sampler = self._get_sampler(pool_key, lines)
+            candidates = (sampler.pick() for _ in range(self.MAX_CLAIM_ATTEMPTS))
+        
+        image_url = fallback_url = None
+        repeated = False
+        for candidate, sampler_repeated in candidates:
+            # 跳过近期失效的链接和熔断中的主机
+            if not self.health.is_usable(candidate):
+                continue
+            if scope is None or await self._claim_sent(scope, candidate):
+                image_url = candidate
+                # 有发送历史时以历史为准，登记成功即说明该范围在窗口内没有发送过
+                repeated = sampler_repeated and self.history is None
+                break
+            fallback_url = candidate
+        
+        if image_url is None:
+            if fallback_url is None:
+                logger.warning(f"链接池 {pool_key} 中抽到的链接暂时都不可用")
+                return None
+            # 候选URL都已在去重窗口内发送给该范围，允许重复
+            image_url, repeated = fallback_url, True
+            await self._mark_sent(scope, image_url)
+        
+        # 如果所有图片都在1小时内发送过，则允许重复
+        if repeated:
+            self.metrics.incr("dedup_fallbacks", f"txt:{pool_key}")
+            logger.debug(f"所有 {len(lines)} 个图片URL在1小时内都已发送过，将允许重复发送")
+        logger.debug(f"随机选择的图片URL: {image_url}")
+        
+        # 下载图片
+        started = time.perf_counter()
+        image_path = await self._download_image(image_url)
+        self.health.record_source(f"txt:{pool_key}", bool(image_path), (time.perf_counter() - started) * 1000)
+        return (image_url, image_path) if image_path else None
+    
+    def _create_history_backend(self):
+        """按配置创建发送历史后端；内存后端且全局去重时采样器已足够，不再额外记录"""
+        backend = self.config.get("dedup_backend", "memory")
+        if backend == "sqlite":
+            db_path = self.config.get("dedup_db_path", "") or os.path.join(self.work_dir, "history.db")
+            return SqliteHistory(db_path, self.sent_images_timeout)
+        if self.dedup_scope != "global":
+            return MemoryHistory(self.sent_images_timeout)
+        return None
+    
+    def _dedup_scope_key(self, event: AstrMessageEvent) -> str:
+        """发送历史的范围键：全局共用一个，或按群/用户分别去重"""
+        if self.dedup_scope == "group":
+            return event.get_group_id() or f"private:{event.get_sender_id()}"
+        if self.dedup_scope == "user":
+            return f"user:{event.get_sender_id()}"
+        return ""
+    
+    async def _claim_sent(self, scope: str, url: str) -> bool:
+        """在发送历史中登记URL，窗口内已发送给该范围时返回False；历史后端出错时不拦截"""
+        if self.history is None:
+            return True
         try:
-            image_extensions = {'.jpg', '.jpeg', '.png', '.gif', '.bmp'}
-            image_files = [
-                f for f in os.listdir(self.local_image_dir)
-                if os.path.splitext(f)[1].lower() in image_extensions
-            ]
-            
-            if not image_files:
+            return await self.history.claim(scope, url, time.time())
+        except Exception as e:
+            logger.error(f"查询发送历史失败: {e}")
+            return True
+    
+    async def _mark_sent(self, scope: str, url: str):
+        if self.history is None:
+            return
+        try:
+            await self.history.mark(scope, url, time.time())
+        except Exception as e:
+            logger.error(f"写入发送历史失败: {e}")
+    
+    async def _prefetch_source(self, source: str) -> Optional[Tuple[str, str]]:
+        """预取队列的补充函数：按来源获取一张新图片"""
+        if source == "api":
+            return await self._fetch_from_api()
+        pool_key = source[len("txt:"):]
+        lines = self.url_pools.get(pool_key)
+        if not lines:
+            return None
+        return await self._fetch_from_pool(pool_key, lines, None)
+    
+    def _get_sampler(self, pool_key: str, lines: Tuple[str, ...]) -> NonRepeatingSampler:
+        """获取链接池对应的采样器，链接列表变化时增量重建"""
+        sampler = self._samplers.get(pool_key)
+        if sampler is None:
+            sampler = NonRepeatingSampler(lines, self.sent_images_timeout)
+            self._samplers[pool_key] = sampler
+        elif sampler.items is not lines:
+            sampler.rebuild(lines)
+        return sampler
+    
+    async def _get_image_from_local_dir(self, index: Optional[LocalImageIndex] = None) -> Optional[str]:
+        """从本地图片目录获取图片，直接返回原文件路径而不复制"""
+        try:
+            index = index or self.local_index
+            await index.refresh()
+            if not index.files:
                 return None
             
-            # 随机选择一个图片
-            selected_image = random.choice(image_files)
-            return os.path.join(self.local_image_dir, selected_image)
+            # 与链接池共用去重采样器，去重窗口内不重复选择同一张图片
+            sampler = self._get_sampler(f"local:{index.root}", index.files)
+            for _ in range(self.MAX_CLAIM_ATTEMPTS):
+                image_path, _ = sampler.pick()
+                # 索引刷新前文件可能已被删除
+                if os.path.isfile(image_path):
+                    return image_path
         except Exception as e:
             logger.error(f"从本地目录获取图片失败: {e}")
         return None
@@ -345,214 +2425,290 @@ class ImageResponsePlugin(Star):
     async def _get_image_from_api(self) -> Optional[str]:
         """从外部API获取图片"""
         try:
-            async with await self._get_http_client() as client:
-                response = await client.get(self.external_api)
-                response.raise_for_status()
-                
-                data = response.json()
-                
-                # 处理不同API的响应格式
-                if 'data' in data and isinstance(data['data'], list) and data['data']:
-                    # 兼容lolicon.app API
-                    image_info = data['data'][0]
-                    if 'urls' in image_info and 'original' in image_info['urls']:
-                        image_url = image_info['urls']['original']
-                    elif 'url' in image_info:
-                        image_url = image_info['url']
-                    else:
-                        return None
-                elif 'url' in data:
-                    # 直接返回URL
-                    image_url = data['url']
-                else:
-                    return None
-                
-                return await self._download_image(image_url)
+            # 优先使用预取好的图片
+            item = self.prefetcher.take("api")
+            if item:
+                logger.debug(f"使用预取的API图片: {item[1]}")
+                return item[1]
+            
+            result = await self._fetch_from_api()
+            return result[1] if result else None
         except Exception as e:
             logger.error(f"从API获取图片失败: {e}")
         return None
     
-    async def _download_image(self, url: str) -> Optional[str]:
-        """下载图片并返回本地路径"""
+    async def _fetch_from_api(self) -> Optional[Tuple[str, str]]:
+        """从API结果缓冲中取一条记录并下载图片，返回 (URL, 图片路径)"""
+        if not self.external_api:
+            return None
+        record = await self.api_buffer.take()
+        if record is None:
+            return None
+        image_url = record[0]
+        
+        started = time.perf_counter()
+        image_path = await self._download_image(image_url)
+        self.health.record_source("api", bool(image_path), (time.perf_counter() - started) * 1000)
+        return (image_url, image_path) if image_path else None
+    
+    async def _request_api_batch(self, num: int) -> List[Tuple[str, dict]]:
+        """请求外部API，返回 [(图片URL, 元数据)]；支持 num 参数的API一次返回多条"""
+        # 外部API熔断中时直接跳过，不再每次等待超时
+        if not self.api_breaker.allow():
+            logger.debug("外部API熔断中，跳过")
+            return []
+        
+        # 在原有查询参数（如 r18、tag）上追加 num；httpx 的 params 会整体替换URL中的查询参数
+        api_url = httpx.URL(self.external_api)
+        if num > 1 and "num" not in api_url.params:
+            api_url = api_url.copy_merge_params({"num": num})
+        
+        started = time.perf_counter()
         try:
-            # 创建临时文件，使用更清晰的命名规则
-            timestamp = int(time.time() * 1000)
-            random_id = random.randint(1000, 9999)
-            
-            # 获取文件扩展名
-            ext = os.path.splitext(url)[1] or '.jpg'
-            if ext.startswith('?'):
-                ext = '.jpg'
-            
-            # 使用自定义临时文件名，确保在临时目录内
-            temp_filename = f"img_{timestamp}_{random_id}{ext}"
-            temp_path = os.path.join(self.temp_dir, temp_filename)
-            
-            # 确保临时目录存在
-            os.makedirs(self.temp_dir, exist_ok=True)
-            
-            async with await self._get_http_client() as client:
-                response = await client.get(url)
+            client = await self._get_http_client()
+            async with self.api_semaphore:
+                response = await client.get(api_url)
                 response.raise_for_status()
                 
-                async with aiofiles.open(temp_path, 'wb') as f:
-                    await f.write(response.content)
-                
-            logger.info(f"图片下载成功: {temp_path}")
-            return temp_path
+                data = response.json()
+        except Exception:
+            self.api_breaker.record_failure()
+            self.health.record_source("api", False, (time.perf_counter() - started) * 1000)
+            raise
+        self.api_breaker.record_success()
+        
+        # 处理不同API的响应格式
+        records = []
+        if 'data' in data and isinstance(data['data'], list):
+            # 兼容lolicon.app API
+            for image_info in data['data']:
+                if not isinstance(image_info, dict):
+                    continue
+                urls = image_info.get('urls')
+                if isinstance(urls, dict) and 'original' in urls:
+                    records.append((urls['original'], image_info))
+                elif 'url' in image_info:
+                    records.append((image_info['url'], image_info))
+        elif 'url' in data:
+            # 直接返回URL
+            records.append((data['url'], data))
+        return records
+    
+    async def _download_image(self, url: str) -> Optional[str]:
+        """下载图片并返回本地路径，命中磁盘缓存时不再发起网络请求"""
+        try:
+            cached_path = await self.disk_cache.get(ImageCache.key_for(url))
+            if cached_path:
+                self.metrics.incr("cache_hits")
+                logger.debug(f"命中图片缓存: {cached_path}")
+                return cached_path
+            
+            # 同一URL的并发下载只发起一次请求
+            task = self._pending_downloads.get(url)
+            if task is None:
+                task = asyncio.create_task(self._fetch_to_cache(url))
+                self._pending_downloads[url] = task
+                task.add_done_callback(lambda _: self._pending_downloads.pop(url, None))
+            return await asyncio.shield(task)
         except Exception as e:
             logger.error(f"下载图片失败: {e}")
         return None
     
+    async def _fetch_to_cache(self, url: str) -> str:
+        """流式下载图片到缓存目录，超过大小上限时中止，完成后原子地移入缓存"""
+        if not self.health.host_breaker(url).allow():
+            raise RuntimeError(f"图片主机熔断中: {urlsplit(url).hostname}")
+        
+        started = time.perf_counter()
+        cache_key = ImageCache.key_for(url)
+        temp_path = self.disk_cache.temp_path(cache_key)
+        try:
+            client = await self._get_http_client()
+            async with self.host_limiter(url):
+                async with client.stream("GET", url) as response:
+                    response.raise_for_status()
+                    
+                    # 响应头声明的大小已超限时不再下载
+                    content_length = response.headers.get("Content-Length", "")
+                    if content_length.isdigit() and int(content_length) > self.max_image_bytes:
+                        raise ValueError(f"图片过大: {content_length} 字节")
+                    
+                    ext = None
+                    received = 0
+                    async with aiofiles.open(temp_path, 'wb') as f:
+                        async for chunk in response.aiter_bytes(self.DOWNLOAD_CHUNK_SIZE):
+                            if ext is None:
+                                # 根据文件头判断图片格式，不再依赖URL后缀
+                                ext = _sniff_image_ext(chunk, response.headers.get("Content-Type", ""))
+                                if ext is None:
+                                    raise ValueError(f"响应内容不是图片: {response.headers.get('Content-Type', '')}")
+                            received += len(chunk)
+                            if received > self.max_image_bytes:
+                                raise ValueError(f"图片超过大小上限 {self.max_image_bytes} 字节")
+                            await f.write(chunk)
+                    
+                    if not received:
+                        raise ValueError("响应内容为空")
+            
+            image_path = await self.disk_cache.put(cache_key, temp_path, ext)
+        except BaseException as e:
+            ImageCache._remove_files([temp_path])
+            if isinstance(e, Exception):
+                self.health.record_failure(url, dead=_is_dead_link_error(e))
+                self.metrics.incr("download_failures")
+            raise
+        
+        self.health.record_success(url)
+        self.metrics.incr("downloads")
+        self.metrics.observe("download", (time.perf_counter() - started) * 1000)
+        logger.debug(f"图片下载成功: {image_path}")
+        return image_path
+    
     async def add_watermark(self, image_path: str) -> str:
-        """为图片添加水印"""
+        """为图片添加水印，结果按（源图片, 水印参数）缓存，重复图片不再重新渲染"""
         try:
-            # 使用asyncio.to_thread避免阻塞事件循环
-            return await asyncio.to_thread(self._add_watermark_sync, image_path)
+            return await self._get_derived_image(
+                image_path,
+                self._watermark_tag,
+                lambda src, dst: self.image_workers.run(
+                    _apply_watermark, src, dst, self.watermark_text, self._watermark_font_path
+                ),
+            )
         except Exception as e:
             logger.error(f"添加水印失败: {e}")
             return image_path
     
-    def _add_watermark_sync(self, image_path: str) -> str:
-        """同步添加水印的方法"""
-        with PILImage.open(image_path) as img:
-            # 创建绘制对象
-            draw = ImageDraw.Draw(img)
-            
-            # 尝试加载指定字体或使用默认字体
-            try:
-                if self.watermark_font:
-                    font_path = os.path.join(self.font_dir, self.watermark_font)
-                    if os.path.exists(font_path):
-                        font_size = max(10, min(30, img.height // 20))
-                        font = ImageFont.truetype(font_path, font_size)
-                    else:
-                        font = ImageFont.load_default()
-                else:
-                    font = ImageFont.load_default()
-            except:
-                font = ImageFont.load_default()
-            
-            # 计算水印位置（右下角）
-            text = self.watermark_text
-            # 获取文本边界框
-            try:
-                bbox = draw.textbbox((0, 0), text, font=font)
-                text_width = bbox[2] - bbox[0]
-                text_height = bbox[3] - bbox[1]
-            except:
-                # 降级处理
-                text_width, text_height = 100, 20
-            
-            # 水印位置：右下角，带边距
-            margin = 20
-            x = img.width - text_width - margin
-            y = img.height - text_height - margin
+    async def transform_image(self, image_path: str) -> str:
+        """按配置缩小、重新编码图片并去除元数据，结果按（源图片, 压缩参数）缓存"""
+        if not self._transform_tag:
+            return image_path
+        try:
+            cache_key = self.disk_cache.derived_key(image_path, self._transform_tag)
+            if cache_key in self._transform_skipped:
+                return image_path
             
-            # 绘制半透明水印
-            # 先绘制半透明背景
-            draw.rectangle(
-                [(x - 5, y - 5), (x + text_width + 5, y + text_height + 5)],
-                fill=(255, 255, 255, 100)
+            max_dimension, target_format, quality, max_bytes = self._transform_params
+            result = await self._get_derived_image(
+                image_path,
+                self._transform_tag,
+                lambda src, dst: self.image_workers.run(
+                    _transform_image, src, dst, max_dimension, target_format, quality, max_bytes
+                ),
             )
-            # 绘制文字
-            draw.text((x, y), text, font=font, fill=(0, 0, 0, 180))
-            
-            # 保存带水印的图片
-            watermarked_path = image_path + "_watermarked" + os.path.splitext(image_path)[1]
-            img.save(watermarked_path)
-            
-            return watermarked_path
-    
-    async def _get_from_cache(self, keyword: str) -> Optional[str]:
-        """从缓存获取图片"""
-        current_time = time.time()
-        if keyword in self.image_cache:
-            cached_time, image_path = self.image_cache[keyword]
-            # 检查是否过期
-            if current_time - cached_time < self.cache_duration:
-                # 检查文件是否存在
-                if os.path.exists(image_path):
-                    return image_path
-                else:
-                    # 文件不存在，从缓存中移除
-                    del self.image_cache[keyword]
+            if result == image_path:
+                # 压缩没有收益，之后直接使用原图
+                self._transform_skipped.set(cache_key)
+            return result
+        except Exception as e:
+            logger.error(f"压缩图片失败: {e}")
+            return image_path
+    
+    async def _get_derived_image(self, image_path: str, tag: str,
+                                 render: Callable[[str, str], Awaitable[Optional[str]]]) -> str:
+        """获取派生图片：优先命中缓存，否则渲染后写入缓存；同一派生图片的并发请求只渲染一次"""
+        cache_key = self.disk_cache.derived_key(image_path, tag)
+        cached_path = await self.disk_cache.get(cache_key)
+        if cached_path:
+            logger.debug(f"命中派生图片缓存: {cached_path}")
+            return cached_path
         
-        # 清理过期缓存
-        self._clean_cache(current_time)
-        return None
+        task = self._pending_derived.get(cache_key)
+        if task is None:
+            task = asyncio.create_task(self._render_derived(image_path, cache_key, render))
+            self._pending_derived[cache_key] = task
+            task.add_done_callback(lambda _: self._pending_derived.pop(cache_key, None))
+        return await asyncio.shield(task)
     
-    async def _add_to_cache(self, keyword: str, image_path: str):
-        """添加图片到缓存 - 已修改为不进行缓存，确保每次都获取新图片"""
-        # 不进行缓存，确保每次都获取新的随机图片
-        # 保留该方法以保持代码结构完整性，但不执行实际缓存操作
-        pass
-    
-    def _clean_cache(self, current_time: float):
-        """清理过期缓存"""
-        expired_keys = [
-            key for key, (cached_time, _) in self.image_cache.items()
-            if current_time - cached_time >= self.cache_duration
-        ]
-        for key in expired_keys:
-            # 尝试删除临时文件
+    async def _render_derived(self, image_path: str, cache_key: str,
+                              render: Callable[[str, str], Awaitable[Optional[str]]]) -> str:
+        """渲染派生图片并写入缓存，render 返回None时直接使用源图片"""
+        temp_path = self.disk_cache.temp_path(cache_key)
+        try:
+            async with self.disk_semaphore:
+                ext = await render(image_path, temp_path)
+            if ext is None:
+                ImageCache._remove_files([temp_path])
+                return image_path
+            return await self.disk_cache.put(cache_key, temp_path, ext)
+        except BaseException:
+            ImageCache._remove_files([temp_path])
+            raise
+    
+    def _load_transform_config(self):
+        """读取图片压缩配置，全部为默认值时不启用压缩"""
+        max_dimension = self.config.get("image_max_dimension", 0)
+        target_format = self.config.get("image_format", "").strip().upper()
+        if target_format == "JPG":
+            target_format = "JPEG"
+        quality = self.config.get("image_quality", 85)
+        max_bytes = self.config.get("image_max_kb", 0) * 1024
+        
+        self._transform_params = (max_dimension, target_format, quality, max_bytes)
+        if not (max_dimension or target_format or max_bytes):
+            self._transform_tag = ""
+        else:
+            params = json.dumps(self._transform_params)
+            self._transform_tag = "tf" + hashlib.sha1(params.encode('utf-8')).hexdigest()[:12]
+    
+    def _compute_watermark_tag(self) -> str:
+        """水印参数的标签，参数变化后旧的水印图片不再命中"""
+        params = json.dumps([self.watermark_text, self._watermark_font_path], ensure_ascii=False)
+        return "wm" + hashlib.sha1(params.encode('utf-8')).hexdigest()[:12]
+    
+    def _resolve_watermark_font(self) -> str:
+        """返回水印字体文件的完整路径，未配置或文件不存在时返回空字符串（使用默认字体）"""
+        if self.watermark_font:
+            font_path = os.path.join(self.font_dir, self.watermark_font)
+            if os.path.exists(font_path):
+                return font_path
+            logger.warning(f"水印字体文件不存在: {font_path}，将使用默认字体")
+        return ""
+    
+    def _ensure_background_tasks(self):
+        """启动后台维护任务（需要在事件循环中调用）"""
+        if self._maintenance_task is None or self._maintenance_task.done():
+            self._maintenance_task = asyncio.create_task(self._maintenance_loop())
+    
+    async def _maintenance_loop(self):
+        """定期清理过期记录，不占用消息处理路径，每轮只输出一条汇总日志"""
+        reported_evictions = self.disk_cache.evictions
+        while True:
+            await asyncio.sleep(self.MAINTENANCE_INTERVAL)
             try:
-                _, image_path = self.image_cache[key]
-                if os.path.exists(image_path):
-                    os.remove(image_path)
-                    logger.info(f"清理过期缓存图片: {image_path}")
+                now = time.time()
+                released = sum(sampler.release_expired(now) for sampler in self._samplers.values())
+                expired = self._transform_skipped.purge() + self.health.purge()
+                expired += self.user_limiter.purge() + self.group_limiter.purge()
+                if self.history is not None:
+                    expired += await self.history.purge()
+                evicted = self._transform_skipped.evicted
+                self._transform_skipped.evicted = 0
+                cache_evicted = self.disk_cache.evictions - reported_evictions
+                reported_evictions += cache_evicted
+                if released or expired or evicted or cache_evicted:
+                    logger.info(
+                        f"定期清理: 去重记录到期 {released} 条, 缓存记录过期 {expired} 条, 超出上限淘汰 {evicted} 条, "
+                        f"图片缓存淘汰 {cache_evicted} 个文件"
+                    )
             except Exception as e:
-                logger.error(f"删除过期缓存图片失败: {e}")
-            del self.image_cache[key]
+                logger.error(f"定期清理失败: {e}")
             
-    def _clean_expired_sent_images(self, current_time: float):
-        """清理过期的已发送图片记录"""
-        expired_urls = [
-            url for url, timestamp in self.sent_images.items()
-            if current_time - timestamp > self.sent_images_timeout
-        ]
-        for url in expired_urls:
-            self.sent_images.pop(url, None)
-            logger.info(f"清理过期的已发送图片记录: {url}")
-            
-    def _clean_old_temp_files(self):
-        """清理旧的临时文件"""
-        try:
-            if not os.path.exists(self.temp_dir):
-                return
-                
-            current_time = time.time()
-            # 清理24小时前的临时文件
-            max_age = 24 * 3600  # 24小时
+            try:
+                removed, freed = await asyncio.to_thread(self.temp_janitor.sweep_sync)
+                if removed:
+                    logger.info(f"临时目录清理: 删除 {removed} 个文件, 释放 {freed / 1048576:.1f} MB")
+            except Exception as e:
+                logger.error(f"清理临时目录失败: {e}")
             
-            for filename in os.listdir(self.temp_dir):
-                file_path = os.path.join(self.temp_dir, filename)
-                if os.path.isfile(file_path):
-                    file_age = current_time - os.path.getmtime(file_path)
-                    if file_age > max_age:
-                        try:
-                            os.remove(file_path)
-                            logger.info(f"清理旧临时文件: {file_path}")
-                        except Exception as e:
-                            logger.error(f"删除旧临时文件失败: {e}")
-        except Exception as e:
-            logger.error(f"清理临时文件时出错: {e}")
+            if self.metrics_file:
+                try:
+                    await asyncio.to_thread(self._write_metrics_file, self.metrics.prometheus())
+                except Exception as e:
+                    logger.error(f"导出运行指标失败: {e}")
     
-    def __del__(self):
-        """清理资源"""
-        # 清理所有缓存的临时文件
-        try:
-            for _, image_path in self.image_cache.values():
-                if os.path.exists(image_path):
-                    os.remove(image_path)
-                    logger.info(f"程序退出时清理缓存图片: {image_path}")
-        except Exception as e:
-            logger.error(f"程序退出时清理缓存图片失败: {e}")
-        
-        # 清理临时目录中的所有文件
-        try:
-            if os.path.exists(self.temp_dir):
-                shutil.rmtree(self.temp_dir)
-                logger.info(f"程序退出时清理临时目录: {self.temp_dir}")
-        except Exception as e:
-            logger.error(f"程序退出时清理临时目录失败: {e}")
\ No newline at end of file
+    def _write_metrics_file(self, text: str):
+        """写入 Prometheus 文本格式的指标文件（先写临时文件再替换，避免读到一半的内容）"""
+        temp_path = f"{self.metrics_file}.tmp"
+        with open(temp_path, 'w', encoding='utf-8') as f:
+            f.write(text)
+        os.replace(temp_path, self.metrics_file)
@@ -0,0 +1,37 @@
+"""测试共用的夹具"""
+import asyncio
+
+import pytest
+
+from tests.image_server import ImageServer
+from tests.stubs import make_plugin
+
+
+@pytest.fixture
+def run_plugin(tmp_path):
+    """在本地图片服务器上创建插件并执行 scenario(plugin, server)，返回 (scenario 的返回值, 服务器)
+
+    pools 为 {链接池文件名: URL路径列表}，路径拼接在服务器地址之后写入 tu 目录；
+    默认不使用外部API、不预取。结束后关闭插件，服务器的请求计数仍可读取。
+    """
+    tu_dir = tmp_path / "tu"
+    tu_dir.mkdir()
+
+    def run(scenario, pools=None, **config):
+        config.setdefault("tu_dir", str(tu_dir))
+        config.setdefault("external_api", "")
+        config.setdefault("prefetch_depth", 0)
+
+        async def main(server):
+            for name, paths in (pools or {}).items():
+                (tu_dir / f"{name}.txt").write_text("".join(f"{server.url}{path}\n" for path in paths), encoding="utf-8")
+            plugin = make_plugin(tmp_path / "work", **config)
+            try:
+                return await scenario(plugin, server)
+            finally:
+                await plugin.terminate()
+
+        with ImageServer() as server:
+            return asyncio.run(main(server)), server
+
+    return run
@@ -0,0 +1,103 @@
+"""本地图片服务器，用于测试和压测，可配置延迟和失败率
+
+路径：
+- /img/<编号>.jpg       返回预先生成的图片（按编号轮流使用）
+- /status/<状态码>/...  直接返回该状态码（模拟失效链接、服务端错误）
+- /api                  lolicon v2 格式的JSON，支持 num 参数，返回的链接指向 /img/
+其余路径返回404。每个请求按 failure_rate 概率返回500，并在响应前等待 latency 秒。
+"""
+import io
+import json
+import random
+import threading
+import time
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+from PIL import Image as PILImage
+
+
+def make_images(count=4, size=(800, 600), fmt="JPEG"):
+    """生成若干张内容不同的测试图片"""
+    images = []
+    for i in range(count):
+        image = PILImage.new("RGB", size, ((i * 61) % 256, (i * 113) % 256, (i * 197) % 256))
+        buffer = io.BytesIO()
+        image.save(buffer, fmt)
+        images.append(buffer.getvalue())
+    return images
+
+
+class _Handler(BaseHTTPRequestHandler):
+    server: "ImageServer"
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        server = self.server
+        parts = urlsplit(self.path)
+        with server.lock:
+            server.requests[parts.path.split("/")[1] if "/" in parts.path else parts.path] += 1
+            server.queries.append(parts.query)
+        if server.latency:
+            time.sleep(server.latency)
+
+        if server.failure_rate and random.random() < server.failure_rate:
+            return self._send(500, b"injected failure", "text/plain")
+
+        if parts.path.startswith("/img/"):
+            try:
+                index = int(parts.path[5:].split(".")[0])
+            except ValueError:
+                return self._send(404, b"", "text/plain")
+            return self._send(200, server.images[index % len(server.images)], "image/jpeg")
+        if parts.path.startswith("/status/"):
+            return self._send(int(parts.path.split("/")[2]), b"", "text/plain")
+        if parts.path == "/api":
+            num = int(parse_qs(parts.query).get("num", ["1"])[0])
+            with server.lock:
+                start = server.api_counter
+                server.api_counter += num
+            data = [
+                {"pid": start + i, "urls": {"original": f"{server.url}/img/{start + i}.jpg"}}
+                for i in range(num)
+            ]
+            return self._send(200, json.dumps({"error": "", "data": data}).encode(), "application/json")
+        return self._send(404, b"", "text/plain")
+
+    def _send(self, status, body, content_type):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class ImageServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, latency=0.0, failure_rate=0.0, images=None):
+        super().__init__(("127.0.0.1", 0), _Handler)
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.images = images or make_images()
+        self.lock = threading.Lock()
+        self.requests = Counter()  # {路径第一段: 请求数}
+        self.queries = []          # 每个请求的查询字符串
+        self.api_counter = 0
+        self.url = f"http://127.0.0.1:{self.server_address[1]}"
+        self._thread = threading.Thread(target=self.serve_forever, daemon=True)
+
+    def handle_error(self, request, client_address):
+        # 客户端提前断开（取消下载、关闭连接池）不是错误
+        pass
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.shutdown()
+        self.server_close()
@@ -0,0 +1,136 @@
+"""最小化的 AstrBot 接口替身，用于在没有安装 AstrBot 的环境中加载插件做测试和压测
+
+只实现插件实际用到的部分：装饰器、Star 基类、配置对象、消息事件和消息组件。
+"""
+import logging
+import os
+import sys
+import types
+
+PLUGIN_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+class AstrBotConfig(dict):
+    """插件配置，和 AstrBot 一样按字典读取"""
+
+
+class Context:
+    pass
+
+
+class Star:
+    def __init__(self, context):
+        self.context = context
+
+
+def register(*args, **kwargs):
+    return lambda cls: cls
+
+
+class _Filter:
+    class EventMessageType:
+        ALL = "all"
+
+    @staticmethod
+    def event_message_type(*args, **kwargs):
+        return lambda func: func
+
+    @staticmethod
+    def command(*args, **kwargs):
+        return lambda func: func
+
+
+class Plain:
+    def __init__(self, text):
+        self.text = text
+
+
+class At:
+    def __init__(self, qq):
+        self.qq = qq
+
+
+class Image:
+    def __init__(self, file):
+        self.file = file
+
+
+class MessageEventResult:
+    def __init__(self, kind, value):
+        self.kind = kind
+        self.value = value
+
+    @property
+    def image(self):
+        """结果中的图片路径（没有图片时为None）"""
+        if self.kind != "chain":
+            return None
+        return next((item.file for item in self.value if isinstance(item, Image)), None)
+
+
+class AstrMessageEvent:
+    """消息事件替身"""
+
+    def __init__(self, message_str, sender_id="10000", group_id="20000"):
+        self.message_str = message_str
+        self._sender_id = sender_id
+        self._group_id = group_id
+
+    def get_sender_id(self):
+        return self._sender_id
+
+    def get_group_id(self):
+        return self._group_id
+
+    def plain_result(self, text):
+        return MessageEventResult("plain", text)
+
+    def chain_result(self, chain):
+        return MessageEventResult("chain", chain)
+
+
+def install():
+    """把替身模块注册为 astrbot.api.*，之后即可 import main"""
+    if "astrbot.api" in sys.modules and getattr(sys.modules["astrbot.api"], "_stub", False):
+        return
+    modules = {name: types.ModuleType(name) for name in (
+        "astrbot", "astrbot.api", "astrbot.api.event", "astrbot.api.star", "astrbot.api.message_components",
+    )}
+    api = modules["astrbot.api"]
+    api._stub = True
+    api.logger = logging.getLogger("astrbot")
+    api.AstrBotConfig = AstrBotConfig
+    event = modules["astrbot.api.event"]
+    event.filter = _Filter
+    event.AstrMessageEvent = AstrMessageEvent
+    event.MessageEventResult = MessageEventResult
+    star = modules["astrbot.api.star"]
+    star.Context = Context
+    star.Star = Star
+    star.register = register
+    components = modules["astrbot.api.message_components"]
+    components.Plain = Plain
+    components.At = At
+    components.Image = Image
+    components.__all__ = ["Plain", "At", "Image"]
+    sys.modules.update(modules)
+    if PLUGIN_DIR not in sys.path:
+        sys.path.insert(0, PLUGIN_DIR)
+
+
+def load_plugin_module():
+    install()
+    import main
+    return main
+
+
+def make_plugin(work_dir, **config):
+    """创建插件实例：运行数据写入 work_dir，其余配置项原样传入（如 tu_dir 指定链接池目录）"""
+    main = load_plugin_module()
+    config.setdefault("work_dir", str(work_dir))
+    return main.ImageResponsePlugin(Context(), AstrBotConfig(config))
+
+
+async def collect(async_gen):
+    """依次取出事件处理器产生的全部结果"""
+    return [result async for result in async_gen]
@@ -0,0 +1,27 @@
+"""外部API批量请求：追加 num 参数时保留原有的查询参数"""
+from urllib.parse import parse_qs
+
+
+def _api_queries(run_plugin, api_path, **config):
+    async def scenario(plugin, server):
+        plugin.external_api = f"{server.url}{api_path}"
+        assert await plugin._fetch_from_api()
+
+    _, server = run_plugin(scenario, **config)
+    # 图片下载请求没有查询参数，剩下的就是API请求
+    return [parse_qs(query) for query in server.queries if query]
+
+
+def test_batch_request_keeps_filters(run_plugin):
+    queries = _api_queries(run_plugin, "/api?r18=1&tag=萝莉&tag=白丝", api_batch_size=5)
+    assert queries[0] == {"r18": ["1"], "tag": ["萝莉", "白丝"], "num": ["5"]}
+
+
+def test_configured_num_is_not_overridden(run_plugin):
+    queries = _api_queries(run_plugin, "/api?num=3&r18=0", api_batch_size=5)
+    assert queries[0] == {"num": ["3"], "r18": ["0"]}
+
+
+def test_single_request_adds_no_num(run_plugin):
+    queries = _api_queries(run_plugin, "/api?r18=0", api_batch_size=1)
+    assert queries[0] == {"r18": ["0"]}
@@ -0,0 +1,89 @@
+"""请求合并：同一群的突发请求共用一次来源选择，各自得到不同的图片"""
+import asyncio
+import time
+
+from tests.stubs import AstrMessageEvent, collect, make_plugin
+
+
+def _burst(run_plugin, urls, count=5, **config):
+    """同一个群同时发出 count 条触发消息，返回 (回复图片列表, 服务器请求计数, 插件)"""
+    async def scenario(plugin, server):
+        replies = await asyncio.gather(*(
+            collect(plugin.keyword_handler(AstrMessageEvent("来张色图", sender_id=str(i), group_id="1")))
+            for i in range(count)
+        ))
+        return [result.image for results in replies for result in results], plugin
+
+    (images, plugin), server = run_plugin(scenario, pools={"pool": urls}, **config)
+    return images, server.requests, plugin
+
+
+def test_burst_gets_distinct_images_from_one_batch(run_plugin):
+    images, requests, plugin = _burst(run_plugin, [f"/img/{i}.jpg" for i in range(50)], coalesce_window=0.05)
+    assert len(images) == 5 and all(images)
+    assert len(set(images)) == 5
+    assert plugin.coalescer.batches == 1
+    assert plugin.coalescer.coalesced == 4
+    assert requests["img"] == 5
+
+
+def test_failing_source_is_tried_once_per_batch(run_plugin):
+    images, requests, plugin = _burst(run_plugin, [f"/status/500/{i}.jpg" for i in range(50)], coalesce_window=0.05)
+    # 来源失败时整批一起放弃，不再为每个请求各自重试一遍
+    assert not any(images)
+    assert requests["status"] == 1
+    assert plugin.metrics.count("source_failures") == 1
+
+
+def test_coalescing_and_rate_limits_are_off_by_default(run_plugin):
+    images, requests, plugin = _burst(run_plugin, [f"/img/{i}.jpg" for i in range(50)], count=8)
+    assert len(images) == 8 and all(images)
+    assert plugin.coalescer.batches == 0
+    assert plugin.metrics.count("rate_limited") == 0
+
+
+def test_batch_followers_share_the_reply_deadline(tmp_path):
+    async def scenario():
+        plugin = make_plugin(tmp_path / "work", external_api="", prefetch_depth=0, reply_deadline=0.4)
+        calls = 0
+
+        async def fetch():
+            # 第一张立即成功，之后的请求慢且取不到图片
+            nonlocal calls
+            calls += 1
+            if calls == 1:
+                return "first.jpg"
+            await asyncio.sleep(0.3)
+            return None
+
+        async def sources(keyword, scope):
+            return [("pool", fetch)]
+
+        plugin._image_sources = sources
+        try:
+            started = time.monotonic()
+            results = await plugin._fetch_image_batch(("1", "色图", ""), 2)
+            return results, time.monotonic() - started
+        finally:
+            await plugin.terminate()
+
+    results, elapsed = asyncio.run(scenario())
+    assert results == ["first.jpg", None]
+    # 后续请求及其回退都受整批截止时间约束，不会叠加出两倍的 reply_deadline
+    assert elapsed < 0.55
+
+
+def test_terminate_cancels_pending_batches(tmp_path):
+    async def scenario():
+        plugin = make_plugin(tmp_path / "work", external_api="", prefetch_depth=0, coalesce_window=10)
+        waiting = asyncio.create_task(plugin.coalescer.get(("1", "色图", "")))
+        await asyncio.sleep(0)
+        assert len(plugin.coalescer._running) == 1
+        await plugin.terminate()
+        result = await asyncio.wait_for(waiting, 1)
+        await asyncio.sleep(0)
+        return result, plugin.coalescer
+
+    result, coalescer = asyncio.run(scenario())
+    assert result is None
+    assert not coalescer._running and not coalescer._open
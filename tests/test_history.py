@@ -0,0 +1,121 @@
+"""发送历史：SQLite 后端在多个进程间共享，同一 URL 在窗口内只能被登记一次"""
+import asyncio
+import multiprocessing
+import random
+
+from tests.stubs import load_plugin_module
+
+main = load_plugin_module()
+
+WINDOW = 3600
+PROCESSES = 4
+URLS = [f"https://example.com/img/{i}.jpg" for i in range(300)]
+
+
+def _claim_all(db_path, scope, seed, barrier, results):
+    """子进程：所有进程同时开始，按各自的随机顺序尝试登记全部URL，返回登记成功的URL"""
+    history = main.SqliteHistory(db_path, WINDOW)
+    urls = list(URLS)
+    random.Random(seed).shuffle(urls)
+
+    async def run():
+        barrier.wait()
+        claimed = [url for url in urls if await history.claim(scope, url, 1000.0)]
+        await history.close()
+        return claimed
+
+    results.put((scope, asyncio.run(run())))
+
+
+def _run_processes(db_path, scopes):
+    context = multiprocessing.get_context("spawn")
+    barrier = context.Barrier(len(scopes))
+    results = context.Queue()
+    processes = [
+        context.Process(target=_claim_all, args=(db_path, scope, seed, barrier, results))
+        for seed, scope in enumerate(scopes)
+    ]
+    for process in processes:
+        process.start()
+    # 结果按完成顺序到达，返回 [(范围, 登记成功的URL)]
+    claimed = [results.get(timeout=60) for _ in processes]
+    for process in processes:
+        process.join(timeout=60)
+        assert process.exitcode == 0
+    return claimed
+
+
+def test_sqlite_history_claims_each_url_once_across_processes(tmp_path):
+    db_path = str(tmp_path / "history.db")
+    claimed = _run_processes(db_path, ["global"] * PROCESSES)
+
+    # 每个URL恰好被一个进程登记成功
+    flat = [url for _, urls in claimed for url in urls]
+    assert sorted(flat) == sorted(URLS)
+
+
+def test_sqlite_history_scopes_are_independent_across_processes(tmp_path):
+    db_path = str(tmp_path / "history.db")
+    claimed = _run_processes(db_path, ["group:1", "group:1", "group:2", "group:2"])
+
+    for scope in ("group:1", "group:2"):
+        assert sorted(url for claimed_scope, urls in claimed if claimed_scope == scope for url in urls) == sorted(URLS)
+
+
+def test_sqlite_history_survives_restart_and_expires(tmp_path):
+    db_path = str(tmp_path / "history.db")
+
+    async def scenario():
+        history = main.SqliteHistory(db_path, WINDOW)
+        assert await history.claim("g", URLS[0], 1000.0)
+        await history.mark("g", URLS[1], 1000.0)
+        await history.close()
+
+        # 重启后记录仍然有效
+        history = main.SqliteHistory(db_path, WINDOW)
+        assert not await history.claim("g", URLS[0], 1000.0 + WINDOW - 1)
+        assert not await history.claim("g", URLS[1], 1000.0 + WINDOW - 1)
+        assert await history.claim("other", URLS[0], 1000.0)
+        # 超过窗口后可以再次登记
+        assert await history.claim("g", URLS[0], 1000.0 + WINDOW)
+        await history.close()
+
+    asyncio.run(scenario())
+
+
+def test_memory_history_is_scoped():
+    async def scenario():
+        history = main.MemoryHistory(WINDOW)
+        assert await history.claim("group:1", URLS[0], 0)
+        assert not await history.claim("group:1", URLS[0], 0)
+        assert await history.claim("group:2", URLS[0], 0)
+        await history.mark("group:2", URLS[1], 0)
+        assert not await history.claim("group:2", URLS[1], 0)
+        await history.close()
+        assert await history.claim("group:1", URLS[0], 0)
+
+    asyncio.run(scenario())
+
+
+def test_group_scope_does_not_share_the_sampler(run_plugin):
+    async def scenario(plugin, server):
+        await plugin.url_pools.refresh()
+        pool_key = plugin.url_pools.find("pool")
+        lines = plugin.url_pools.get(pool_key)
+        sent = {}
+        for scope in ("group:A", "group:B"):
+            sent[scope] = [(await plugin._fetch_from_pool(pool_key, lines, scope))[0] for _ in range(3)]
+        fallbacks_before = plugin.metrics.count("dedup_fallbacks")
+        # 该群已经收到过全部图片，再取才算重复
+        await plugin._fetch_from_pool(pool_key, lines, "group:A")
+        return sent, fallbacks_before, plugin.metrics.count("dedup_fallbacks")
+
+    (sent, fallbacks_before, fallbacks_after), _ = run_plugin(
+        scenario, pools={"pool": [f"/img/{i}.jpg" for i in range(3)]}, dedup_scope="group"
+    )
+
+    # 每个群都能拿到全部3张图片，互不影响
+    assert sorted(sent["group:A"]) == sorted(sent["group:B"])
+    assert len(set(sent["group:B"])) == 3
+    assert fallbacks_before == 0
+    assert fallbacks_after == 1
@@ -0,0 +1,69 @@
+"""运行统计：Prometheus 导出格式、来源失败计数和图片缓存淘汰计数"""
+import asyncio
+import logging
+import os
+
+from tests.stubs import AstrMessageEvent, collect, load_plugin_module, make_plugin
+
+main = load_plugin_module()
+
+
+def test_prometheus_escapes_label_values():
+    metrics = main.PipelineMetrics()
+    metrics.incr("source_hits", 'txt:C:\\图片\\"a"\nb')
+    metrics.observe("reply", 12)
+    text = metrics.prometheus()
+    assert 'image_response_source_hits_total{source="txt:C:\\\\图片\\\\\\"a\\"\\nb"} 1\n' in text
+    assert 'image_response_stage_duration_ms_count{stage="reply"} 1\n' in text
+    # 每个样本一行，标签值中的换行不会拆开样本
+    assert all(line.startswith(("# TYPE", "image_response_")) for line in text.splitlines())
+
+
+def test_keyword_without_txt_file_is_not_a_source_failure(run_plugin):
+    async def scenario(plugin, server):
+        # 还没有任何回复时统计也不应以空行开头
+        stats = await collect(plugin.stats_command(AstrMessageEvent("/image_stats")))
+        replies = await collect(plugin.keyword_handler(AstrMessageEvent("来张色图")))
+        return plugin.metrics, replies, stats[0].value
+
+    (metrics, replies, stats), _ = run_plugin(scenario, pools={"pool": [f"/img/{i}.jpg" for i in range(20)]})
+
+    assert replies[0].image
+    # "色图" 没有同名的TXT文件，直接从配置的TXT文件取图，不记为来源失败
+    assert metrics.count("source_failures") == 0
+    assert metrics.counters[("source_hits", "configured_txt")] == 1
+    assert not stats.startswith("\n")
+
+
+def test_cache_evictions_are_counted_not_logged(tmp_path, caplog):
+    cache = main.ImageCache(str(tmp_path / "cache"), max_bytes=25, ttl=0)
+
+    async def scenario():
+        await cache.load()
+        for i in range(5):
+            temp_path = cache.temp_path(f"{i:040d}")
+            with open(temp_path, "wb") as f:
+                f.write(b"x" * 10)
+            await cache.put(f"{i:040d}", temp_path, ".jpg")
+
+    with caplog.at_level(logging.INFO, logger="astrbot"):
+        asyncio.run(scenario())
+
+    # 上限只能放下2个文件，之后每次写入都淘汰一个，只计数不逐次输出INFO日志
+    assert cache.evictions == 3
+    assert len(os.listdir(tmp_path / "cache")) == 2
+    assert not [record for record in caplog.records if "淘汰" in record.getMessage()]
+
+
+def test_help_lists_commands_and_disk_cache(tmp_path):
+    async def scenario():
+        plugin = make_plugin(tmp_path / "work", external_api="", prefetch_depth=0, image_cache_max_mb=64, image_cache_ttl=0)
+        try:
+            return (await collect(plugin.help_command(AstrMessageEvent("/image_help"))))[0].value
+        finally:
+            await plugin.terminate()
+
+    help_text = asyncio.run(scenario())
+    assert "/image_stats" in help_text and "/image_reload" in help_text
+    assert "上限 64 MB, 有效期 不过期" in help_text
+    assert "5分钟" not in help_text
@@ -0,0 +1,19 @@
+"""端到端：替身 AstrBot 环境中从触发消息到回复图片"""
+import os
+
+from tests.stubs import AstrMessageEvent, collect
+
+
+def test_keyword_message_replies_with_downloaded_image(tmp_path, run_plugin):
+    async def scenario(plugin, server):
+        ignored = await collect(plugin.keyword_handler(AstrMessageEvent("今天天气不错")))
+        replies = await collect(plugin.keyword_handler(AstrMessageEvent("来张色图")))
+        return ignored, replies
+
+    (ignored, replies), _ = run_plugin(scenario, pools={"pool": [f"/img/{i}.jpg" for i in range(20)]})
+
+    assert ignored == []
+    assert len(replies) == 1
+    image = replies[0].image
+    assert image and os.path.isfile(image)
+    assert image.startswith(str(tmp_path / "work" / "cache"))
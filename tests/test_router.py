@@ -0,0 +1,88 @@
+"""关键词路由：正则规则各自编译并在构建时解析到触发关键词，重载配置失败时不改动现有状态"""
+import asyncio
+
+import pytest
+
+from tests.stubs import AstrMessageEvent, collect, load_plugin_module, make_plugin
+
+main = load_plugin_module()
+
+
+def test_regex_rules_compile_independently():
+    router = main.KeywordRouter([
+        "re:(?i)色图 = api",
+        r"re:(a)\1 = local",
+        "re:(?P<tag>白丝) = 白丝.txt",
+        "re:(?P<tag>黑丝) = 黑丝.txt*2",
+        "re:( = api",
+        "猫猫, 狗狗 = animals",
+    ], ["来张色图", "aa", "ab", "白丝", "黑丝"])
+    assert router.lookup("来张色图") == ((("api", ""), 1.0),)
+    # 反向引用仍指向规则自己的分组
+    assert router.lookup("aa") == ((("local", ""), 1.0),)
+    assert router.lookup("ab") is None
+    assert router.lookup("白丝") == ((("txt", "白丝.txt"), 1.0),)
+    assert router.lookup("黑丝") == ((("txt", "黑丝.txt"), 2.0),)
+    assert router.lookup("狗狗") == ((("txt", "animals"), 1.0),)
+    assert router.keywords == ["猫猫", "狗狗"]
+    assert router.targets("txt") == {"白丝.txt", "黑丝.txt", "animals"}
+
+
+def test_regex_rules_match_in_config_order():
+    router = main.KeywordRouter(["re:图 = first", "re:色图 = second"], ["色图"])
+    assert router.lookup("色图") == ((("txt", "first"), 1.0),)
+
+
+def test_regex_rules_only_route_trigger_keywords():
+    router = main.KeywordRouter(["re:猫+ = api", "狗狗 = dogs", "re:狗 = api"], ["猫猫", "狗狗"])
+    assert router.lookup("猫猫") == ((("api", ""), 1.0),)
+    # 不在触发关键词中的文本不会被正则路由；别名的路由优先于正则
+    assert router.lookup("猫猫猫") is None
+    assert router.lookup("狗狗") == ((("txt", "dogs"), 1.0),)
+    assert router.keywords == ["狗狗"]
+    assert router.targets("txt") == {"dogs"}
+
+
+def test_reload_keeps_state_when_router_fails(tmp_path, monkeypatch):
+    async def scenario():
+        plugin = make_plugin(tmp_path / "work", external_api="", prefetch_depth=0, keywords=["色图"])
+        invalidated = []
+
+        async def invalidate(*args, **kwargs):
+            invalidated.append(args)
+
+        def broken_router(rules, keywords):
+            raise RuntimeError("broken")
+
+        try:
+            matcher, router = plugin.keyword_matcher, plugin.router
+            plugin.config["keywords"] = ["猫猫"]
+            plugin.config["watermark_text"] = "新水印"
+            monkeypatch.setattr(plugin.disk_cache, "invalidate", invalidate)
+            monkeypatch.setattr(main, "KeywordRouter", broken_router)
+            replies = await collect(plugin.reload_command(AstrMessageEvent("/image_reload")))
+        finally:
+            await plugin.terminate()
+        assert "失败" in replies[0].value
+        assert plugin.keywords == ["色图"]
+        assert plugin.watermark_text == ""
+        assert plugin.keyword_matcher is matcher and plugin.router is router
+        assert invalidated == []
+
+    asyncio.run(scenario())
+
+
+@pytest.mark.parametrize("rule", ["re:(?i)色图 = api", r"re:(a)\1 = api"])
+def test_reload_with_regex_rules(tmp_path, rule):
+    async def scenario():
+        plugin = make_plugin(tmp_path / "work", external_api="", prefetch_depth=0)
+        try:
+            plugin.config["keywords"] = ["色图", "aa", "b"]
+            plugin.config["keyword_routes"] = [rule, "re:(?P<x>a) = api", "re:(?P<x>b) = api"]
+            replies = await collect(plugin.reload_command(AstrMessageEvent("/image_reload")))
+        finally:
+            await plugin.terminate()
+        assert replies[0].value.startswith("配置已重新加载")
+        assert plugin.router.lookup("b") == ((("api", ""), 1.0),)
+
+    asyncio.run(scenario())
@@ -0,0 +1,53 @@
+"""FairScheduler：名额转交与超时同时发生时不能泄漏名额"""
+import asyncio
+
+from tests.stubs import load_plugin_module
+
+main = load_plugin_module()
+
+
+def test_timeout_after_handoff_returns_the_slot(monkeypatch):
+    scheduler = main.FairScheduler(limit=1, max_waiting_per_group=5, max_waiting_per_user=2)
+    real_wait_for = asyncio.wait_for
+
+    async def handoff_then_timeout(future, timeout):
+        # 模拟 Python 3.12 的行为：release() 刚把名额交给等待者，wait_for 仍然抛出超时
+        scheduler.release()
+        assert future.done()
+        raise asyncio.TimeoutError
+
+    async def scenario():
+        assert await scheduler.acquire("g", "u1", 1)
+        monkeypatch.setattr(asyncio, "wait_for", handoff_then_timeout)
+        try:
+            assert not await scheduler.acquire("g", "u2", 1)
+        finally:
+            monkeypatch.setattr(asyncio, "wait_for", real_wait_for)
+        # 第一个请求已通过 release() 交出名额，超时的等待者也归还了名额
+        assert scheduler.active == 0
+        assert scheduler.waiting == 0
+        assert await scheduler.acquire("g", "u3", 1)
+
+    asyncio.run(scenario())
+
+
+def test_queued_requests_are_served_round_robin_across_groups():
+    scheduler = main.FairScheduler(limit=1, max_waiting_per_group=5, max_waiting_per_user=5)
+    order = []
+
+    async def request(group, user):
+        assert await scheduler.acquire(group, user, 5)
+        order.append(group)
+        await asyncio.sleep(0)
+        scheduler.release()
+
+    async def scenario():
+        assert await scheduler.acquire("holder", "h", 1)
+        tasks = [asyncio.create_task(request("spam", f"u{i}")) for i in range(3)]
+        tasks.append(asyncio.create_task(request("quiet", "q")))
+        await asyncio.sleep(0)
+        scheduler.release()
+        await asyncio.gather(*tasks)
+
+    asyncio.run(scenario())
+    assert order[:2] == ["spam", "quiet"]
@@ -0,0 +1,119 @@
+"""来源健康：失效链接负缓存、按主机熔断、外部API熔断和按成功率加权选择来源（本地图片服务器）"""
+import random
+
+import pytest
+
+from tests.stubs import load_plugin_module
+
+main = load_plugin_module()
+
+
+async def _pool(plugin, name):
+    await plugin.url_pools.refresh()
+    pool_key = plugin.url_pools.find(name)
+    return pool_key, plugin.url_pools.get(pool_key)
+
+
+def test_dead_link_is_requested_once(run_plugin):
+    async def scenario(plugin, server):
+        pool_key, lines = await _pool(plugin, "dead")
+        for _ in range(5):
+            assert await plugin._fetch_from_pool(pool_key, lines, "") is None
+        # 404 进入负缓存，之后不再抽取
+        assert server.requests["status"] == 1
+
+    run_plugin(scenario, pools={"dead": ["/status/404/a.jpg"]})
+
+
+def test_host_breaker_opens_and_probes(run_plugin):
+    async def scenario(plugin, server):
+        for i in range(5):
+            assert await plugin._download_image(f"{server.url}/status/500/{i}.jpg") is None
+        # 连续3次服务端错误后主机熔断，后两次没有发出请求
+        assert server.requests["status"] == 3
+        breaker = plugin.health.host_breaker(server.url)
+        assert breaker.state == "open"
+        assert await plugin._download_image(f"{server.url}/img/0.jpg") is None
+        assert server.requests["img"] == 0
+
+        # 冷却结束后放行一次试探，成功后恢复
+        breaker._opened_at -= plugin.health.cooldown
+        assert breaker.state == "half-open"
+        assert await plugin._download_image(f"{server.url}/img/0.jpg")
+        assert breaker.state == "closed"
+        assert await plugin._download_image(f"{server.url}/img/1.jpg")
+        assert server.requests["img"] == 2
+
+    run_plugin(scenario, source_failure_threshold=3, source_cooldown=60)
+
+
+def test_failed_probe_reopens_host_breaker(run_plugin):
+    async def scenario(plugin, server):
+        for i in range(2):
+            await plugin._download_image(f"{server.url}/status/503/{i}.jpg")
+        breaker = plugin.health.host_breaker(server.url)
+        breaker._opened_at -= plugin.health.cooldown
+        # 试探失败后立即重新熔断，不需要再累计到阈值
+        assert await plugin._download_image(f"{server.url}/status/503/probe.jpg") is None
+        assert breaker.state == "open"
+        assert server.requests["status"] == 3
+
+    run_plugin(scenario, source_failure_threshold=2, source_cooldown=60)
+
+
+def test_api_breaker_skips_failing_api(run_plugin):
+    async def scenario(plugin, server):
+        plugin.external_api = f"{server.url}/status/503/api"
+        for _ in range(2):
+            with pytest.raises(Exception):
+                await plugin._request_api_batch(1)
+        assert plugin.api_breaker.state == "open"
+        # 熔断中直接返回空结果，不再请求
+        assert await plugin._request_api_batch(1) == []
+        assert server.requests["status"] == 2
+
+        plugin.external_api = f"{server.url}/api"
+        plugin.api_breaker._opened_at -= plugin.health.cooldown
+        records = await plugin._request_api_batch(1)
+        assert records and records[0][0].startswith(f"{server.url}/img/")
+        assert plugin.api_breaker.state == "closed"
+
+    run_plugin(scenario, source_failure_threshold=2, source_cooldown=60)
+
+
+def test_api_breaker_trips_on_failing_endpoint(run_plugin):
+    async def scenario(plugin, server):
+        plugin.external_api = f"{server.url}/status/502/api"
+        for _ in range(3):
+            assert await plugin._fetch_from_api() is None
+        assert plugin.api_breaker.state == "open"
+        assert server.requests["status"] == 2
+
+    run_plugin(scenario, source_failure_threshold=2, source_cooldown=60, api_batch_size=1)
+
+
+def test_configured_pools_are_weighted_by_health(run_plugin):
+    random.seed(0)
+
+    async def scenario(plugin, server):
+        for _ in range(60):
+            await plugin._get_image_from_configured_txt("")
+        # 失效链接池第一次失败后权重降到很低，绝大多数请求落在正常的链接池
+        assert server.requests["status"] < 15
+        assert server.requests["img"] > 45
+        assert plugin.health.weight(f"txt:{(await _pool(plugin, 'bad'))[0]}") < 0.1
+
+    run_plugin(scenario, pools={
+        "good": [f"/img/{i}.jpg" for i in range(200)],
+        "bad": [f"/status/404/{i}.jpg" for i in range(200)],
+    })
+
+
+def test_source_weight_prefers_fast_successful_sources():
+    health = main.SourceHealth(dead_ttl=60, retry_ttl=60, failure_threshold=3, cooldown=60)
+    assert health.weight("unknown") == 1.0
+    for _ in range(5):
+        health.record_source("fast", True, 50)
+        health.record_source("slow", True, 3000)
+        health.record_source("flaky", False, 50)
+    assert health.weight("fast") > health.weight("slow") > health.weight("flaky")
@@ -0,0 +1,24 @@
+"""临时目录清理：只按存放时间删除遗留文件"""
+import os
+import time
+
+from tests.stubs import load_plugin_module
+
+main = load_plugin_module()
+
+
+def test_sweep_removes_only_expired_files(tmp_path):
+    old_time = time.time() - 7200
+    for name in ("old.jpg", "1.png"):
+        (tmp_path / name).write_bytes(b"x" * 10)
+        os.utime(tmp_path / name, (old_time, old_time))
+    (tmp_path / "new.jpg").write_bytes(b"x" * 10)
+    (tmp_path / "subdir").mkdir()
+
+    janitor = main.TempJanitor(str(tmp_path), max_age=3600, keep=("1.png",))
+    assert janitor.sweep_sync() == (1, 10)
+    assert sorted(os.listdir(tmp_path)) == ["1.png", "new.jpg", "subdir"]
+
+
+def test_sweep_missing_directory(tmp_path):
+    assert main.TempJanitor(str(tmp_path / "missing"), max_age=60).sweep_sync() == (0, 0)
@@ -0,0 +1,49 @@
+"""图片压缩：重新编码时去除元数据"""
+import io
+
+import pytest
+from PIL import Image as PILImage, ImageCms
+
+from tests.stubs import load_plugin_module
+
+main = load_plugin_module()
+
+
+def _source_jpeg(path):
+    exif = PILImage.Exif()
+    exif[0x010E] = "secret description"
+    icc = ImageCms.ImageCmsProfile(ImageCms.createProfile("sRGB")).tobytes()
+    PILImage.linear_gradient("L").resize((1200, 800)).convert("RGB").save(
+        path, "JPEG", quality=95, exif=exif, comment="secret comment", icc_profile=icc
+    )
+    return icc
+
+
+@pytest.mark.parametrize("target_format, ext", [("JPEG", ".jpg"), ("WEBP", ".webp"), ("PNG", ".png")])
+def test_transform_strips_metadata(tmp_path, target_format, ext):
+    src, dst = str(tmp_path / "src.jpg"), str(tmp_path / "out")
+    icc = _source_jpeg(src)
+    with PILImage.open(src) as img:
+        assert img.info.get("comment") == b"secret comment" and img.getexif()
+
+    assert main._transform_image(src, dst, 600, target_format, 85, 0) == ext
+    with open(dst, "rb") as f:
+        data = f.read()
+    assert b"secret" not in data
+    with PILImage.open(io.BytesIO(data)) as out:
+        assert out.size == (600, 400)
+        assert "comment" not in out.info
+        assert not out.getexif()
+        assert out.info.get("icc_profile") == icc
+
+
+def test_transform_keeps_palette_transparency(tmp_path):
+    src, dst = str(tmp_path / "src.png"), str(tmp_path / "out")
+    img = PILImage.new("P", (800, 800), 0)
+    img.putpalette([0, 0, 0, 255, 0, 0] + [0] * 762)
+    img.paste(1, (0, 0, 400, 800))
+    img.save(src, "PNG", transparency=0)
+
+    assert main._transform_image(src, dst, 400, "PNG", 85, 0) == ".png"
+    with PILImage.open(dst) as out:
+        assert out.convert("RGBA").getpixel((399, 10))[3] == 0
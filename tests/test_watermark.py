@@ -0,0 +1,32 @@
+"""水印渲染：各种尺寸和模式的图片都能正确合成"""
+import pytest
+from PIL import Image as PILImage
+
+from tests.stubs import load_plugin_module
+
+main = load_plugin_module()
+
+
+@pytest.mark.parametrize("size", [(20, 10), (1, 1), (60, 400), (400, 30), (800, 600)])
+@pytest.mark.parametrize("mode,fmt,ext", [("RGB", "JPEG", ".jpg"), ("RGBA", "PNG", ".png"), ("P", "GIF", ".gif")])
+def test_watermark_any_size(tmp_path, size, mode, fmt, ext):
+    source = tmp_path / f"source{ext}"
+    PILImage.new(mode, size).save(source, fmt)
+    output = tmp_path / f"output{ext}"
+
+    assert main._apply_watermark(str(source), str(output), "水印 watermark", "") == ext
+
+    with PILImage.open(output) as result:
+        assert result.size == size
+        assert result.format == fmt
+
+
+def test_watermark_changes_bottom_right_corner(tmp_path):
+    source = tmp_path / "source.png"
+    PILImage.new("RGB", (300, 200), (0, 0, 0)).save(source)
+    output = tmp_path / "output.png"
+    main._apply_watermark(str(source), str(output), "watermark", "")
+    with PILImage.open(output) as result:
+        corner = result.crop((150, 150, 300, 200))
+        assert corner.getextrema() != ((0, 0), (0, 0), (0, 0))
+        assert result.getpixel((0, 0)) == (0, 0, 0)